@@ -0,0 +1,9 @@
+# Web-процес (лише Flask). Планувальник — окремий процес: python main.py --scheduler
+import os
+
+bind = os.getenv("BIND", "0.0.0.0:80")
+workers = int(os.getenv("WEB_CONCURRENCY", "2"))
+threads = int(os.getenv("WEB_THREADS", "4"))
+# /run_sync і /sync_products виконують синхронізацію прямо в запиті — вона може тривати годинами
+timeout = int(os.getenv("WEB_TIMEOUT", "0"))
+accesslog = "-"
@@ -1,10 +1,32 @@
-from flask import Flask, render_template_string, jsonify, request
+from flask import Flask, render_template_string, jsonify, request, Response
 import requests
 import json
 import httpx
 import time
 import fcntl
+import sqlite3
+import zlib
+import socket
+import uuid
+import multiprocessing
+import heapq
+import math
+import statistics
+import argparse
+import random
+import re
+import threading
+import concurrent.futures
+import unicodedata
+from urllib.parse import urlsplit
+from collections import deque
+from contextlib import contextmanager
+try:
+    import msgpack  # компактніший снапшот каталогу; без нього — JSON
+except ImportError:
+    msgpack = None
 from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.schedulers.blocking import BlockingScheduler
 from apscheduler.executors.pool import ThreadPoolExecutor
 from apscheduler.triggers.interval import IntervalTrigger
 from datetime import datetime, timedelta, timezone
@@ -23,9 +45,76 @@ access_token = os.getenv('SHOPIFY_ACCESS_TOKEN')
 # Базовий інтервал автосинхронізації (хв)
 SCHEDULE_MINUTES = 180
 JOB_ID = "sync_job"
+HEARTBEAT_JOB_ID = "scheduler_heartbeat"
+# Планувальник живе в окремому процесі (python main.py --scheduler) і раз на тік
+# перевіряє next_run_time у спільному сховищі стану; heartbeat пишеться окремим job-ом,
+# бо тік, що запустив синк, зайнятий годинами
+SCHEDULER_TICK_SECONDS = 30
 LOCK_FILE_PATH = "/tmp/integration_1c_shopify_sync.lock"
-SHOPIFY_FULL_FETCH_RESTARTS = 3
+# Скільки разів повторювати збійну сторінку каталогу з її збереженого Link-курсора
+SHOPIFY_PAGE_RETRIES = 3
 SHOPIFY_PAGE_LIMIT = 125
+# Знімок каталогу Shopify на диску: теплі запуски тягнуть лише змінене з updated_at_min
+CATALOG_SNAPSHOT_PATH = os.getenv('SHOPIFY_SNAPSHOT_PATH', '/tmp/integration_1c_shopify_catalog.snapshot')
+# updated_at не бачить видалень — періодично збираємо все наново. Залишки на теплих запусках
+# освіжаються окремо з inventory_levels: їхня зміна не оновлює updated_at товару
+CATALOG_SNAPSHOT_MAX_AGE_HOURS = float(os.getenv('SHOPIFY_SNAPSHOT_MAX_AGE_HOURS', '24'))
+CATALOG_SNAPSHOT_OVERLAP_SECONDS = 120
+# ⚠️ ПІДСТАВ СВІЙ location_id
+SHOPIFY_LOCATION_ID = 73379741896
+
+# Шардований режим: SKU розбиваються на K шардів, кожен шард має lease у спільному SQLite
+SYNC_SHARDS = int(os.getenv('SYNC_SHARDS', '1'))
+SYNC_WORKERS = int(os.getenv('SYNC_WORKERS', str(os.cpu_count() or 1)))
+SHARD_LEASE_SECONDS = 300
+STATE_DB_PATH = os.getenv('SYNC_STATE_DB', '/tmp/integration_1c_shopify_state.sqlite3')
+# Спільний для всіх процесів бюджет запитів до Shopify (REST: ~2 запити/с)
+SHOPIFY_MIN_REQUEST_INTERVAL = 0.6
+
+# Пакетне створення товарів через GraphQL productSet (з'явився в 2024-04)
+SHOPIFY_GRAPHQL_VERSION = "2024-07"
+# GraphQL має окремий бюджет (cost points): productSet ~10 балів, відновлення 50 балів/с
+SHOPIFY_GRAPHQL_MIN_REQUEST_INTERVAL = 0.25
+BULK_CREATE_MIN_ITEMS = int(os.getenv('BULK_CREATE_MIN_ITEMS', '20'))
+BULK_CREATE_CONCURRENCY = int(os.getenv('BULK_CREATE_CONCURRENCY', '4'))
+
+# Пріоритети черги запису (менше значення — раніше). Перевизначення: SYNC_PRIORITY_WEIGHTS='{"price": 5}'
+DEFAULT_PRIORITY_WEIGHTS = {
+    "out_of_stock": 0,   # товар закінчився в 1С
+    "stock_drop": 10,    # велике падіння залишку
+    "price": 20,
+    "stock": 30,
+    "create": 40,
+    "unchanged": 50,
+}
+PRIORITY_WEIGHTS = {**DEFAULT_PRIORITY_WEIGHTS, **json.loads(os.getenv('SYNC_PRIORITY_WEIGHTS') or '{}')}
+# Частка падіння залишку, з якої зміна вважається "великою"
+STOCK_DROP_RATIO = float(os.getenv('SYNC_STOCK_DROP_RATIO', '0.5'))
+
+# Адаптивний інтервал: підлаштовуємо розклад під частку змін, тривалість запусків і запас rate limit
+ADAPTIVE_SCHEDULE = os.getenv('ADAPTIVE_SCHEDULE', '0') == '1'
+ADAPTIVE_MIN_MINUTES = int(os.getenv('ADAPTIVE_MIN_MINUTES', '30'))
+ADAPTIVE_MAX_MINUTES = int(os.getenv('ADAPTIVE_MAX_MINUTES', '360'))
+ADAPTIVE_HISTORY = 5
+ADAPTIVE_HIGH_CHANGE_RATIO = 0.2
+ADAPTIVE_LOW_CHANGE_RATIO = 0.02
+ADAPTIVE_MIN_HEADROOM = 0.2
+
+# Історія запусків: запуск позначається як регресія, якщо throughput нижчий за медіану
+# останніх RUN_BASELINE_WINDOW запусків більш ніж на RUN_REGRESSION_THRESHOLD
+RUN_BASELINE_WINDOW = 10
+RUN_BASELINE_MIN_RUNS = 3
+RUN_REGRESSION_THRESHOLD = float(os.getenv('RUN_REGRESSION_THRESHOLD', '0.3'))
+
+# Політика ретраїв: jittered exponential backoff, бюджет ретраїв на запуск, circuit breaker на endpoint
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 30.0
+RETRY_BUDGET_PER_RUN = int(os.getenv('SYNC_RETRY_BUDGET', '200'))
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+BREAKER_FAILURE_THRESHOLD = 5
+BREAKER_COOLDOWN_SECONDS = 60
+# Скільки максимум чекати в кінці запуску, доки відкриті breaker-и закриються й відкладені запити відправляться
+DEFERRED_DRAIN_MAX_SECONDS = 300
 
 # ================== УТИЛІТИ ==================
 def extract_valid_json(content):
@@ -87,6 +176,36 @@ def normalize_handle(value):
         return ""
     return str(value).strip().lower()
 
+# Транслітерація для handle (uk/ru → латиниця)
+CYRILLIC_TO_LATIN = {
+    "а": "a", "б": "b", "в": "v", "г": "g", "ґ": "g", "д": "d", "е": "e", "є": "ye", "ё": "yo",
+    "ж": "zh", "з": "z", "и": "i", "і": "i", "ї": "yi", "й": "j", "к": "k", "л": "l", "м": "m",
+    "н": "n", "о": "o", "п": "p", "р": "r", "с": "s", "т": "t", "у": "u", "ф": "f", "х": "kh",
+    "ц": "ts", "ч": "ch", "ш": "sh", "щ": "shch", "ъ": "", "ы": "y", "ь": "", "э": "e", "ю": "yu",
+    "я": "ya", "'": "", "’": "", "ʼ": "",
+}
+SHOPIFY_HANDLE_MAX_LENGTH = 255
+
+def slugify_handle(name):
+    """Детермінований handle як у Shopify: латиниця, цифри й дефіси."""
+    text = "".join(CYRILLIC_TO_LATIN.get(ch, ch) for ch in str(name or "").lower())
+    # Латинські діакритики: "café" → "cafe"
+    text = unicodedata.normalize("NFKD", text).encode("ascii", "ignore").decode("ascii")
+    slug = re.sub(r"[^a-z0-9]+", "-", text).strip("-")
+    return slug[:SHOPIFY_HANDLE_MAX_LENGTH].rstrip("-") or "product"
+
+def allocate_handle(handle, all_handles):
+    """Вільний handle в індексі: handle, handle-1, handle-2, ... Резервує результат в all_handles."""
+    reserve = getattr(all_handles, "reserve", None)  # SharedHandleSet у шардованому режимі
+    candidate = handle
+    suffix = 0
+    while candidate in all_handles or (reserve and not reserve(candidate)):
+        suffix += 1
+        tail = f"-{suffix}"
+        candidate = f"{handle[:SHOPIFY_HANDLE_MAX_LENGTH - len(tail)]}{tail}"
+    all_handles.add(candidate)
+    return candidate
+
 def acquire_sync_lock():
     """Крос-процесний lock: запобігає одночасним запускам синку."""
     lock_file = open(LOCK_FILE_PATH, "w")
@@ -107,6 +226,201 @@ def release_sync_lock(lock_file):
     finally:
         lock_file.close()
 
+STATE_DB_SCHEMA = """
+CREATE TABLE IF NOT EXISTS shard_leases (
+    shard INTEGER PRIMARY KEY,
+    owner TEXT NOT NULL,
+    run_id TEXT NOT NULL,
+    expires_at REAL NOT NULL,
+    done INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS shard_runs (
+    run_id TEXT PRIMARY KEY,
+    shard_count INTEGER NOT NULL,
+    opened_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS handle_reservations (
+    handle TEXT PRIMARY KEY,
+    run_id TEXT NOT NULL,
+    reserved_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS rate_budget (
+    name TEXT PRIMARY KEY,
+    next_slot REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS kv_state (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS run_counters (
+    run_id TEXT NOT NULL,
+    name TEXT NOT NULL,
+    value REAL NOT NULL,
+    PRIMARY KEY (run_id, name)
+);
+CREATE TABLE IF NOT EXISTS sync_runs (
+    run_id TEXT PRIMARY KEY,
+    started_at TEXT NOT NULL,
+    finished_at TEXT NOT NULL,
+    status TEXT NOT NULL,
+    duration_seconds REAL NOT NULL,
+    items INTEGER NOT NULL,
+    changed INTEGER NOT NULL,
+    throughput REAL NOT NULL,
+    throttled INTEGER NOT NULL,
+    min_headroom REAL,
+    phases TEXT NOT NULL,
+    requests TEXT NOT NULL,
+    baseline_throughput REAL,
+    regression INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS propagation_metrics (
+    run_id TEXT NOT NULL,
+    change_class TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    total_seconds REAL NOT NULL,
+    max_seconds REAL NOT NULL,
+    recorded_at REAL NOT NULL,
+    PRIMARY KEY (run_id, change_class)
+);
+"""
+
+@contextmanager
+def state_db():
+    """Зʼєднання зі спільним SQLite-сховищем стану (leases, rate budget)."""
+    conn = sqlite3.connect(STATE_DB_PATH, timeout=30, isolation_level=None)
+    try:
+        conn.executescript(STATE_DB_SCHEMA)
+        yield conn
+    finally:
+        conn.close()
+
+def get_state(key, default=None):
+    """Спільний для всіх процесів стан (статус, розклад): JSON-значення за ключем."""
+    with state_db() as conn:
+        row = conn.execute("SELECT value FROM kv_state WHERE key = ?", (key,)).fetchone()
+    return json.loads(row[0]) if row else default
+
+def set_state(**values):
+    with state_db() as conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO kv_state (key, value) VALUES (?, ?)",
+            [(key, json.dumps(value, ensure_ascii=False)) for key, value in values.items()],
+        )
+
+def wait_for_rate_budget(name="shopify", interval=SHOPIFY_MIN_REQUEST_INTERVAL):
+    """Резервуємо слот у глобальному бюджеті запитів і чекаємо на нього."""
+    with state_db() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            now = time.time()
+            row = conn.execute("SELECT next_slot FROM rate_budget WHERE name = ?", (name,)).fetchone()
+            slot = max(now, row[0]) if row else now
+            conn.execute(
+                "INSERT OR REPLACE INTO rate_budget (name, next_slot) VALUES (?, ?)",
+                (name, slot + interval),
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    delay = slot - now
+    if delay > 0:
+        time.sleep(delay)
+
+def shard_for_sku(sku, shard_count):
+    """Стабільний (між процесами й хостами) номер шарда для SKU."""
+    return zlib.crc32(normalize_sku(sku).encode('utf-8')) % shard_count
+
+def acquire_shard_lease(shard, owner, run_id, ttl=SHARD_LEASE_SECONDS):
+    """Захоплюємо/продовжуємо lease шарда. Завершений у цьому ж запуску шард не перезахоплюється."""
+    now = time.time()
+    with state_db() as conn:
+        cursor = conn.execute(
+            """
+            INSERT INTO shard_leases (shard, owner, run_id, expires_at, done) VALUES (?, ?, ?, ?, 0)
+            ON CONFLICT(shard) DO UPDATE SET
+                owner = excluded.owner, run_id = excluded.run_id, expires_at = excluded.expires_at, done = 0
+            WHERE (shard_leases.owner = excluded.owner AND shard_leases.done = 0)
+               OR (shard_leases.expires_at <= ?
+                   AND NOT (shard_leases.run_id = excluded.run_id AND shard_leases.done = 1))
+            """,
+            (shard, owner, run_id, now + ttl, now),
+        )
+        return cursor.rowcount > 0
+
+def join_shard_run(shard_count):
+    """Спільний для всіх хостів run_id шардованого синку: приєднуємось до незавершеного запуску або відкриваємо новий.
+
+    Запуск вважається покинутим, якщо жоден його lease не оновлювався довше за SHARD_LEASE_SECONDS.
+    """
+    now = time.time()
+    with state_db() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT run_id, shard_count, opened_at FROM shard_runs ORDER BY opened_at DESC LIMIT 1"
+            ).fetchone()
+            if row and row[1] == shard_count:
+                run_id, _, opened_at = row
+                done, last_activity = conn.execute(
+                    "SELECT COALESCE(SUM(done), 0), MAX(expires_at) FROM shard_leases WHERE run_id = ?", (run_id,)
+                ).fetchone()
+                if done < shard_count and now - max(opened_at, last_activity or 0) < SHARD_LEASE_SECONDS:
+                    conn.execute("COMMIT")
+                    return run_id
+            run_id = uuid.uuid4().hex
+            conn.execute(
+                "INSERT INTO shard_runs (run_id, shard_count, opened_at) VALUES (?, ?, ?)",
+                (run_id, shard_count, now),
+            )
+            # Створене попередніми запусками вже є в каталозі Shopify
+            conn.execute("DELETE FROM handle_reservations")
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    return run_id
+
+class SharedHandleSet(set):
+    """Індекс handle-ів шард-воркера: нові handle-и резервуються в спільному SQLite.
+
+    Однакові назви з SKU з різних шардів інакше отримали б той самий handle у різних воркерах.
+    """
+
+    def __init__(self, handles, run_id):
+        super().__init__(handles)
+        self.run_id = run_id
+
+    def reserve(self, handle):
+        """Атомарно резервуємо handle за цим запуском. False — його вже взяв інший воркер."""
+        with state_db() as conn:
+            cursor = conn.execute(
+                "INSERT OR IGNORE INTO handle_reservations (handle, run_id, reserved_at) VALUES (?, ?, ?)",
+                (handle, self.run_id, time.time()),
+            )
+            return cursor.rowcount > 0
+
+    def discard(self, handle):
+        super().discard(handle)
+        with state_db() as conn:
+            conn.execute(
+                "DELETE FROM handle_reservations WHERE handle = ? AND run_id = ?", (handle, self.run_id)
+            )
+
+def complete_shard_lease(shard, owner):
+    """Позначаємо шард виконаним і відпускаємо lease. False — lease уже перейшов до іншого воркера."""
+    with state_db() as conn:
+        cursor = conn.execute(
+            "UPDATE shard_leases SET done = 1, expires_at = ? WHERE shard = ? AND owner = ? AND done = 0",
+            (time.time(), shard, owner),
+        )
+        return cursor.rowcount > 0
+
+def release_shard_lease(shard, owner):
+    with state_db() as conn:
+        conn.execute("DELETE FROM shard_leases WHERE shard = ? AND owner = ? AND done = 0", (shard, owner))
+
 def is_success_response(result):
     """Визначаємо, чи sync завершився успішно (2xx)."""
     if result is None:
@@ -121,6 +435,7 @@ def fetch_products():
     try:
         # http2=True вимагає пакет h2; якщо його нема — або встанови `pip install 'httpx[http2]'`, або прибери http2=True
         with httpx.Client(http2=True, verify=False, timeout=20) as client:
+            count_request("GET 1C")
             response = client.get(url)
             print(f"Статус 1С: {response.status_code}")
 
@@ -141,69 +456,334 @@ def fetch_products():
         return None
 
 # ================== Shopify ==================
-def fetch_all_shopify_products():
-    base_url = f"{shopify_store_url}/admin/api/2024-01/products.json"
+def compact_product(product):
+    """Лишаємо в знімку лише поля, потрібні для індексів і diff."""
+    return {
+        "id": product.get("id"),
+        "handle": product.get("handle"),
+        "status": product.get("status"),
+        "updated_at": product.get("updated_at"),
+        "variants": [
+            {
+                "id": v.get("id"),
+                "sku": v.get("sku"),
+                "price": v.get("price"),
+                "inventory_quantity": v.get("inventory_quantity"),
+                "inventory_item_id": v.get("inventory_item_id"),
+            }
+            for v in product.get("variants", [])
+        ],
+    }
+
+def load_catalog_snapshot():
+    try:
+        with open(CATALOG_SNAPSHOT_PATH, "rb") as fp:
+            raw = fp.read()
+    except FileNotFoundError:
+        return None
+    try:
+        if raw[:1] == b"{":
+            return json.loads(raw.decode("utf-8"))
+        if msgpack is None:
+            print("⚠️ Знімок каталогу у форматі msgpack, але пакет msgpack не встановлено. Повний збір.")
+            return None
+        return msgpack.unpackb(raw, raw=False, strict_map_key=False)
+    except Exception as e:
+        print(f"⚠️ Пошкоджений знімок каталогу ({e}). Повний збір.")
+        return None
+
+def save_catalog_snapshot(snapshot):
+    """Атомарний запис знімка (tmp + rename), щоб паралельний читач не бачив пів файлу."""
+    if msgpack is not None:
+        raw = msgpack.packb(snapshot, use_bin_type=True)
+    else:
+        raw = json.dumps(snapshot, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    tmp_path = f"{CATALOG_SNAPSHOT_PATH}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as fp:
+        fp.write(raw)
+    os.replace(tmp_path, CATALOG_SNAPSHOT_PATH)
+
+def crawl_shopify_pages(resource, params):
+    """Обхід {resource}.json за Link-курсорами; збійна сторінка повторюється зі свого курсора."""
+    base_url = f"{shopify_store_url}/admin/api/2024-01/{resource}.json"
     headers = {
         "Content-Type": "application/json",
         "X-Shopify-Access-Token": access_token
     }
-    for attempt in range(1, SHOPIFY_FULL_FETCH_RESTARTS + 1):
-        all_products = []
-        params = {
-            "limit": SHOPIFY_PAGE_LIMIT,
-            "fields": "id,handle,variants,status"
-        }
-        next_url = base_url
-        page_num = 0
-        failed = False
-
-        print(f"📥 Спроба {attempt}/{SHOPIFY_FULL_FETCH_RESTARTS} повного збору товарів Shopify...")
-        while next_url:
-            page_num += 1
-            time.sleep(0.6)  # rate limit
+    items = []
+    next_url = base_url
+    page_num = 0
+
+    while next_url:
+        page_num += 1
+        response = None
+        for attempt in range(1, SHOPIFY_PAGE_RETRIES + 1):
+            delay = None
+            wait_for_rate_budget()
+            count_request(endpoint_key("GET", base_url))
             try:
                 response = requests.get(next_url, headers=headers, params=params, timeout=30)
             except requests.RequestException as e:
-                print(f"❌ Помилка мережі на сторінці {page_num}: {e}. Перезапуск збору...")
-                failed = True
-                break
-
-            if response.status_code != 200:
-                print(f"❌ Помилка отримання Shopify сторінки {page_num}: {response.status_code}. Перезапуск збору...")
-                failed = True
-                break
-
-            data = response.json().get('products', [])
-            all_products.extend(data)
-            link_header = response.headers.get("Link")
-            if link_header and 'rel="next"' in link_header:
-                parts = link_header.split(",")
-                next_link = next((p for p in parts if 'rel="next"' in p), None)
-                if next_link:
-                    next_url = next_link[next_link.find("<") + 1:next_link.find(">")]
-                    params = None
-                else:
+                print(f"❌ Помилка мережі на сторінці {page_num} (спроба {attempt}/{SHOPIFY_PAGE_RETRIES}): {e}")
+                response = None
+            else:
+                record_rate_limit_headroom(response)
+                if response.status_code == 200:
                     break
+                if response.status_code == 429:
+                    # Як у send_request_with_retry: рахуємо 429 і чекаємо, скільки просить Shopify
+                    count_throttled()
+                    delay = float(response.headers.get("Retry-After", 5))
+                print(f"❌ Помилка отримання Shopify сторінки {page_num} "
+                      f"(спроба {attempt}/{SHOPIFY_PAGE_RETRIES}): {response.status_code}")
+            if attempt < SHOPIFY_PAGE_RETRIES:
+                delay = backoff_delay(attempt) if delay is None else delay
+                print(f"⏳ Повтор сторінки {page_num} з того ж курсора через {delay:.1f} с...")
+                time.sleep(delay)
+        else:
+            return None
+
+        data = response.json().get(resource, [])
+        items.extend(data)
+        link_header = response.headers.get("Link")
+        if link_header and 'rel="next"' in link_header:
+            parts = link_header.split(",")
+            next_link = next((p for p in parts if 'rel="next"' in p), None)
+            if next_link:
+                next_url = next_link[next_link.find("<") + 1:next_link.find(">")]
+                params = None
             else:
                 break
+        else:
+            break
+
+    return items
+
+def crawl_shopify_products(extra_params=None):
+    """Товари каталогу (extra_params — фільтри products.json, напр. updated_at_min)."""
+    return crawl_shopify_pages("products", {
+        "limit": SHOPIFY_PAGE_LIMIT,
+        "fields": "id,handle,variants,status,updated_at",
+        **(extra_params or {}),
+    })
 
-        if not failed:
-            print(f"📦 Отримано товарів з Shopify: {len(all_products)}")
-            return all_products
+def crawl_inventory_levels(since):
+    """Залишки на нашій локації, змінені з since (включно із записаними самим синком)."""
+    return crawl_shopify_pages("inventory_levels", {
+        "location_ids": SHOPIFY_LOCATION_ID,
+        "limit": SHOPIFY_PAGE_LIMIT,
+        "updated_at_min": since.isoformat(),
+    })
+
+def fetch_all_shopify_products():
+    """Каталог Shopify: знімок з диску + інкрементальне оновлення, або повний збір."""
+    crawl_started = datetime.now(timezone.utc)
+    snapshot = load_catalog_snapshot()
+    full_fetched_at = datetime.fromisoformat(snapshot["full_fetched_at"]) if snapshot else None
+
+    if full_fetched_at and crawl_started - full_fetched_at < timedelta(hours=CATALOG_SNAPSHOT_MAX_AGE_HOURS):
+        since = datetime.fromisoformat(snapshot["fetched_at"]) - timedelta(seconds=CATALOG_SNAPSHOT_OVERLAP_SECONDS)
+        print(f"📥 Інкрементальний збір Shopify: змінені з {since.isoformat()}...")
+        changed = crawl_shopify_products({"updated_at_min": since.isoformat()})
+        if changed is None:
+            print("❌ Не вдалося зібрати змінені товари Shopify. Синхронізацію зупинено.")
+            return None
+        levels = crawl_inventory_levels(since)
+        if levels is None:
+            print("❌ Не вдалося зібрати змінені залишки Shopify. Синхронізацію зупинено.")
+            return None
+        by_id = {p["id"]: p for p in snapshot["products"]}
+        for product in changed:
+            by_id[product["id"]] = compact_product(product)
+        products = list(by_id.values())
+        available = {level["inventory_item_id"]: level.get("available") for level in levels}
+        for product in products:
+            for variant in product["variants"]:
+                if variant.get("inventory_item_id") in available:
+                    variant["inventory_quantity"] = available[variant["inventory_item_id"]]
+        print(f"📦 Зі знімка: {len(snapshot['products'])}, змінено/нових: {len(changed)}, "
+              f"змінених залишків: {len(levels)}")
+    else:
+        print("📥 Повний збір товарів Shopify...")
+        crawled = crawl_shopify_products()
+        if crawled is None:
+            print("❌ Не вдалося повністю зібрати товари Shopify. Синхронізацію зупинено.")
+            return None
+        products = [compact_product(p) for p in crawled]
+        full_fetched_at = crawl_started
+
+    save_catalog_snapshot({
+        "version": 1,
+        "fetched_at": crawl_started.isoformat(),
+        "full_fetched_at": full_fetched_at.isoformat(),
+        "products": products,
+    })
+    print(f"📦 Отримано товарів з Shopify: {len(products)}")
+    return products
 
-        if attempt < SHOPIFY_FULL_FETCH_RESTARTS:
-            backoff = attempt * 2
-            print(f"⏳ Повторна спроба повного збору через {backoff} с...")
-            time.sleep(backoff)
+def record_rate_limit_headroom(response):
+    """Запам'ятовуємо найменший запас rate limit за запуск (X-Shopify-Shop-Api-Call-Limit: 32/40)."""
+    header = getattr(response, "headers", {}).get("X-Shopify-Shop-Api-Call-Limit")
+    if not header or "/" not in header:
+        return
+    try:
+        used, limit = (int(x) for x in header.split("/", 1))
+    except ValueError:
+        return
+    if limit <= 0:
+        return
+    headroom = max(0.0, 1 - used / limit)
+    with _metrics_lock:
+        current = run_metrics["min_headroom"]
+        run_metrics["min_headroom"] = headroom if current is None else min(current, headroom)
+
+class CircuitBreaker:
+    """closed → open (N збоїв поспіль) → half_open (після cooldown, пробний запит) → closed."""
+
+    def __init__(self, endpoint, failure_threshold=BREAKER_FAILURE_THRESHOLD, cooldown=BREAKER_COOLDOWN_SECONDS):
+        self.endpoint = endpoint
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def allow_request(self):
+        with self._lock:
+            if self.state == "open" and time.monotonic() - self.opened_at >= self.cooldown:
+                self.state = "half_open"
+                print(f"🟡 Breaker {self.endpoint}: half-open, пробний запит...")
+            return self.state != "open"
+
+    def seconds_until_retry(self):
+        with self._lock:
+            if self.state != "open":
+                return 0.0
+            return max(0.0, self.cooldown - (time.monotonic() - self.opened_at))
+
+    def record_success(self):
+        """Повертає True, якщо breaker щойно закрився після half-open."""
+        with self._lock:
+            recovered = self.state == "half_open"
+            self.state = "closed"
+            self.failures = 0
+            self.opened_at = None
+        if recovered:
+            print(f"🟢 Breaker {self.endpoint}: закрито.")
+        return recovered
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == "half_open" or self.failures >= self.failure_threshold:
+                if self.state != "open":
+                    print(f"🔴 Breaker {self.endpoint}: відкрито на {self.cooldown} с після {self.failures} збоїв.")
+                self.state = "open"
+                self.opened_at = time.monotonic()
+
+circuit_breakers = {}
+deferred_requests = deque()  # (endpoint, url, method, headers, json_data)
+retry_budget = {"remaining": RETRY_BUDGET_PER_RUN}
+_breakers_lock = threading.Lock()
+_draining = threading.local()
+
+def endpoint_key(method, url):
+    """'PUT /admin/api/2024-01/variants/{id}.json' — id-шники не розмножують breaker-и."""
+    path = re.sub(r"/\d+(?=[/.]|$)", "/{id}", urlsplit(url).path)
+    return f"{method} {path}"
+
+def get_circuit_breaker(endpoint):
+    with _breakers_lock:
+        breaker = circuit_breakers.get(endpoint)
+        if breaker is None:
+            breaker = circuit_breakers[endpoint] = CircuitBreaker(endpoint)
+        return breaker
+
+def consume_retry_budget():
+    with _breakers_lock:
+        if retry_budget["remaining"] <= 0:
+            return False
+        retry_budget["remaining"] -= 1
+        return True
 
-    print("❌ Не вдалося повністю зібрати товари Shopify. Синхронізацію зупинено.")
-    return None
+def reset_retry_policy():
+    """Новий запуск — новий бюджет ретраїв. Стан breaker-ів зберігається між запусками."""
+    with _breakers_lock:
+        retry_budget["remaining"] = RETRY_BUDGET_PER_RUN
+
+def backoff_delay(retries):
+    """Full jitter: випадкова затримка в [0, min(max, base * 2^n)]."""
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** retries))
+
+def defer_request(endpoint, url, method, headers, json_data):
+    deferred_requests.append((endpoint, url, method, headers, json_data))
+    print(f"📥 Breaker {endpoint} відкрито — запит відкладено (у черзі: {len(deferred_requests)}).")
+
+def drain_deferred_requests(endpoint=None, max_wait=0, heartbeat=None):
+    """Відправляємо відкладені запити для закритих breaker-ів; max_wait — скільки чекати на відкриті.
+
+    heartbeat() продовжує lease шарда під час очікування; False — lease втрачено, зупиняємось.
+    """
+    if getattr(_draining, "active", False):
+        return 0
+    _draining.active = True
+    sent = 0
+    deadline = time.monotonic() + max_wait
+    try:
+        while deferred_requests:
+            pending = [item for item in deferred_requests if endpoint is None or item[0] == endpoint]
+            if not pending:
+                break
+            progressed = False
+            for item in pending:
+                item_endpoint, url, method, headers, json_data = item
+                if not get_circuit_breaker(item_endpoint).allow_request():
+                    continue
+                deferred_requests.remove(item)
+                send_request_with_retry(url, method=method, headers=headers, json_data=json_data)
+                sent += 1
+                progressed = True
+            if heartbeat and not heartbeat():
+                break
+            if progressed:
+                continue
+            wait = min(get_circuit_breaker(item[0]).seconds_until_retry() for item in pending)
+            if time.monotonic() + wait > deadline:
+                break
+            print(f"⏳ Очікуємо {wait:.0f} с на закриття breaker-ів ({len(pending)} відкладених запитів)...")
+            time.sleep(wait)
+    finally:
+        _draining.active = False
+    if sent:
+        print(f"📤 Відправлено відкладених запитів: {sent}")
+    return sent
+
+def discard_deferred_requests():
+    """Наприкінці запуску: що не вдалося відправити — перерахує наступний синк."""
+    if deferred_requests:
+        print(f"⚠️ Не відправлено {len(deferred_requests)} відкладених запитів — їх врахує наступна синхронізація.")
+        deferred_requests.clear()
+
+def send_request_with_retry(url, method='GET', headers=None, json_data=None, max_retries=5,
+                            rate_budget=None, defer=True):
+    """rate_budget=(назва, інтервал) — інший бюджет замість REST; defer=False — не відкладати (неідемпотентні запити)."""
+    endpoint = endpoint_key(method, url)
+    breaker = get_circuit_breaker(endpoint)
+    if not breaker.allow_request():
+        if defer:
+            defer_request(endpoint, url, method, headers, json_data)
+        return None
 
-def send_request_with_retry(url, method='GET', headers=None, json_data=None, max_retries=5):
     retries = 0
-    while retries < max_retries:
+    while True:
         response = None
         try:
+            if rate_budget:
+                wait_for_rate_budget(*rate_budget)
+            else:
+                wait_for_rate_budget()
+            count_request(endpoint)
             if method == 'GET':
                 response = requests.get(url, headers=headers)
             elif method == 'POST':
@@ -211,46 +791,71 @@ def send_request_with_retry(url, method='GET', headers=None, json_data=None, max
             elif method == 'PUT':
                 response = requests.put(url, headers=headers, json=json_data)
 
-            if response.status_code == 429:
-                retry_after = response.headers.get("Retry-After", 5)
-                print(f"⚠️ 429 | чекаємо {retry_after} с... Спроба {retries + 1}/{max_retries}")
-                time.sleep(int(float(retry_after)))
-                retries += 1
-            else:
+            record_rate_limit_headroom(response)
+            if response.status_code not in RETRYABLE_STATUS_CODES:
                 print(f"✅ Успіх після {retries} ретраїв. Код: {response.status_code}")
+                if breaker.record_success():
+                    drain_deferred_requests(endpoint)
                 return response
+
+            if response.status_code == 429:
+                # 429 — це ліміт, а не збій сервісу: breaker не рахуємо
+                count_throttled()
+                delay = float(response.headers.get("Retry-After", 5))
+                print(f"⚠️ 429 | чекаємо {delay} с... Спроба {retries + 1}/{max_retries}")
+            else:
+                breaker.record_failure()
+                delay = backoff_delay(retries)
+                print(f"⚠️ {response.status_code} | чекаємо {delay:.1f} с... Спроба {retries + 1}/{max_retries}")
         except Exception as e:
+            breaker.record_failure()
+            delay = backoff_delay(retries)
             print(f"❌ Помилка запиту: {e} | Спроба {retries + 1}/{max_retries}")
-            time.sleep(2 ** retries)
-            retries += 1
 
-    print(f"❗ Досягнуто ліміт ретраїв ({max_retries}).")
-    return response
-
-def update_shopify_variant(variant_id, inventory_item_id, new_price, new_quantity):
-    headers = {
+        if not breaker.allow_request():
+            if defer:
+                defer_request(endpoint, url, method, headers, json_data)
+            return response
+        if retries + 1 >= max_retries:
+            print(f"❗ Досягнуто ліміт ретраїв ({max_retries}).")
+            return response
+        if not consume_retry_budget():
+            print("❗ Вичерпано бюджет ретраїв запуску.")
+            return response
+        time.sleep(delay)
+        retries += 1
+
+def shopify_headers():
+    return {
         "Content-Type": "application/json",
         "X-Shopify-Access-Token": access_token
     }
 
-    # Оновлюємо ціну
+def update_variant_price(variant_id, new_price):
     update_variant_url = f"{shopify_store_url}/admin/api/2024-01/variants/{variant_id}.json"
     variant_data = {"variant": {"id": variant_id, "price": new_price}}
-    response = send_request_with_retry(update_variant_url, method='PUT', headers=headers, json_data=variant_data)
+    response = send_request_with_retry(update_variant_url, method='PUT', headers=shopify_headers(), json_data=variant_data)
     if response and response.status_code == 200:
         print(f"✅ Ціну варіанта {variant_id} оновлено.")
-    else:
-        print(f"❌ Помилка оновлення ціни {variant_id}: {response.status_code if response else 'нема відповіді'}")
+        return True
+    print(f"❌ Помилка оновлення ціни {variant_id}: {response.status_code if response else 'нема відповіді'}")
+    return False
 
-    # Оновлюємо кількість через Inventory API
+def update_variant_quantity(variant_id, inventory_item_id, new_quantity):
+    # Кількість оновлюємо через Inventory API
     update_inventory_url = f"{shopify_store_url}/admin/api/2024-01/inventory_levels/set.json"
-    # ⚠️ ПІДСТАВ СВІЙ location_id
-    inventory_data = {"location_id": 73379741896, "inventory_item_id": inventory_item_id, "available": new_quantity}
-    response = send_request_with_retry(update_inventory_url, method='POST', headers=headers, json_data=inventory_data)
+    inventory_data = {"location_id": SHOPIFY_LOCATION_ID, "inventory_item_id": inventory_item_id, "available": new_quantity}
+    response = send_request_with_retry(update_inventory_url, method='POST', headers=shopify_headers(), json_data=inventory_data)
     if response and response.status_code == 200:
         print(f"✅ Кількість варіанта {variant_id} оновлено.")
-    else:
-        print(f"❌ Помилка оновлення кількості {variant_id}: {response.status_code if response else 'нема відповіді'}")
+        return True
+    print(f"❌ Помилка оновлення кількості {variant_id}: {response.status_code if response else 'нема відповіді'}")
+    return False
+
+def update_shopify_variant(variant_id, inventory_item_id, new_price, new_quantity):
+    price_ok = update_variant_price(variant_id, new_price)
+    quantity_ok = update_variant_quantity(variant_id, inventory_item_id, new_quantity)
+    return price_ok and quantity_ok
 
 def transform_to_shopify_format(product):
     """Мапінг товару з 1С у формат створення продукту Shopify."""
@@ -270,7 +875,7 @@ def transform_to_shopify_format(product):
             "title": product['name'],
             "vendor": "MIXOpro.Ukraine",
             "tags": "1C Sync",
-            "handle": product['name'].replace(" ", "-").lower(),
+            "handle": slugify_handle(product['name']),
             "status": "active",
             "variants": [
                 {
@@ -290,6 +895,7 @@ def transform_to_shopify_format(product):
     return shopify_product
 
 def send_to_shopify(shopify_product, existing_products, all_skus, all_handles):
+    """Оновлення за SKU або створення товару. True — Shopify прийняв запис."""
     sku = normalize_sku(shopify_product['product']['variants'][0]['sku'])
     new_price = shopify_product['product']['variants'][0]['price']
     new_quantity = shopify_product['product']['variants'][0]['inventory_quantity']
@@ -309,19 +915,22 @@ def send_to_shopify(shopify_product, existing_products, all_skus, all_handles):
         if existing_product:
             print(f"🔁 SKU {sku} існує. Оновлюємо варіант...")
             variant = next(v for v in existing_product['variants'] if normalize_sku(v.get('sku')) == sku)
-            update_shopify_variant(variant['id'], variant['inventory_item_id'], new_price, new_quantity)
-        return
+            return bool(update_shopify_variant(variant['id'], variant['inventory_item_id'], new_price, new_quantity))
+        return False
 
-    # handle вже є — не створюємо
-    if handle in all_handles:
-        print(f"⚠️ Пропуск — handle вже існує: {handle}")
-        return
+    # handle зайнятий іншим товаром — підбираємо вільний локально, без 422 від Shopify
+    resolved_handle = allocate_handle(handle, all_handles)
+    if resolved_handle != handle:
+        print(f"⚠️ Handle '{handle}' зайнятий — використовуємо '{resolved_handle}'")
+        shopify_product['product']['handle'] = resolved_handle
+        handle = resolved_handle
 
     # Створюємо товар
     print(f"🆕 Створення товару SKU {sku}, handle '{handle}'")
-    time.sleep(0.6)
+    wait_for_rate_budget()
     shopify_url = f"{shopify_store_url}/admin/api/2024-01/products.json"
     headers = {"Content-Type": "application/json", "X-Shopify-Access-Token": access_token}
+    count_request(endpoint_key("POST", shopify_url))
     response = requests.post(shopify_url, headers=headers, json=shopify_product)
     if response.status_code == 201:
         new_product = response.json()['product']
@@ -329,6 +938,7 @@ def send_to_shopify(shopify_product, existing_products, all_skus, all_handles):
         existing_products.append(new_product)
         all_skus.add(normalize_sku(new_product['variants'][0].get('sku')))
         all_handles.add(normalize_handle(new_product.get('handle')))
+        return True
     elif response.status_code == 422:
         # Можливий конфлікт/дубль (наприклад, товар уже створив паралельний процес)
         print(f"⚠️ 422 під час створення SKU {sku}. Перевіряємо Shopify повторно...")
@@ -340,18 +950,273 @@ def send_to_shopify(shopify_product, existing_products, all_skus, all_handles):
         if existing_product:
             variant = next(v for v in existing_product['variants'] if normalize_sku(v.get('sku')) == sku)
             print(f"🔁 Після 422 знайдено SKU {sku}. Оновлюємо замість створення.")
-            update_shopify_variant(variant['id'], variant['inventory_item_id'], new_price, new_quantity)
-        else:
-            print(f"❌ 422 без знайденого SKU {sku}: {response.json()}")
+            return bool(update_shopify_variant(variant['id'], variant['inventory_item_id'], new_price, new_quantity))
+        print(f"❌ 422 без знайденого SKU {sku}: {response.json()}")
     else:
         print(f"❌ Помилка створення: {response.status_code}, {response.json()}")
+    return False
+
+PRODUCT_SET_MUTATION = """
+mutation productSet($input: ProductSetInput!) {
+  productSet(synchronous: true, input: $input) {
+    product {
+      id
+      handle
+      variants(first: 1) { nodes { id sku inventoryItem { id } } }
+    }
+    userErrors { field message code }
+  }
+}
+"""
+
+def gid_to_id(gid):
+    """'gid://shopify/Product/123' → 123"""
+    return int(str(gid).rsplit("/", 1)[-1])
+
+def to_product_set_input(shopify_product):
+    """REST-payload створення → ProductSetInput."""
+    product = shopify_product['product']
+    variant = product['variants'][0]
+    return {
+        "title": product['title'],
+        "vendor": product['vendor'],
+        "tags": [tag.strip() for tag in product['tags'].split(",") if tag.strip()],
+        "handle": product['handle'],
+        "status": product['status'].upper(),
+        "productOptions": [{"name": "Title", "values": [{"name": "Default Title"}]}],
+        "variants": [
+            {
+                "optionValues": [{"optionName": "Title", "name": "Default Title"}],
+                "sku": variant['sku'],
+                "price": variant['price'],
+                "inventoryItem": {
+                    "tracked": variant.get('inventory_management') == "shopify",
+                    "requiresShipping": variant.get('requires_shipping', True),
+                },
+                "inventoryQuantities": [
+                    {
+                        "locationId": f"gid://shopify/Location/{SHOPIFY_LOCATION_ID}",
+                        "name": "available",
+                        "quantity": variant['inventory_quantity'],
+                    }
+                ],
+            }
+        ],
+    }
+
+def create_product_graphql(shopify_product):
+    """Створення одного товару через productSet. Повертає товар у форматі REST-каталогу або None."""
+    graphql_url = f"{shopify_store_url}/admin/api/{SHOPIFY_GRAPHQL_VERSION}/graphql.json"
+    payload = {"query": PRODUCT_SET_MUTATION, "variables": {"input": to_product_set_input(shopify_product)}}
+    response = send_request_with_retry(
+        graphql_url, method='POST', headers=shopify_headers(), json_data=payload,
+        rate_budget=("shopify_graphql", SHOPIFY_GRAPHQL_MIN_REQUEST_INTERVAL), defer=False,
+    )
+    sku = shopify_product['product']['variants'][0]['sku']
+    if not response or response.status_code != 200:
+        print(f"❌ productSet SKU {sku}: {response.status_code if response else 'нема відповіді'}")
+        return None
+
+    body = response.json()
+    result = (body.get('data') or {}).get('productSet') or {}
+    if body.get('errors') or result.get('userErrors') or not result.get('product'):
+        print(f"❌ productSet SKU {sku}: {body.get('errors') or result.get('userErrors')}")
+        return None
+
+    product = result['product']
+    variant = product['variants']['nodes'][0]
+    return {
+        "id": gid_to_id(product['id']),
+        "handle": product['handle'],
+        "variants": [{
+            "id": gid_to_id(variant['id']),
+            "sku": variant['sku'],
+            "inventory_item_id": gid_to_id(variant['inventoryItem']['id']),
+        }],
+    }
+
+def create_products_bulk(shopify_products, existing_products, all_skus, all_handles, on_created=None):
+    """Паралельні productSet у межах GraphQL-бюджету; кожен результат одразу потрапляє в індекси SKU/handle."""
+    batch = []
+    batch_skus = set()
+    fallback = []
+    for shopify_product in shopify_products:
+        sku = normalize_sku(shopify_product['product']['variants'][0]['sku'])
+        if sku in all_skus or sku in batch_skus:
+            # Дубль SKU (у каталозі чи в самому фіді) — REST-шлях після партії оновить, а не створить вдруге
+            fallback.append(shopify_product)
+            continue
+        batch_skus.add(sku)
+        # Handle резервуємо до відправки, щоб паралельні мутації не зіткнулися
+        shopify_product['product']['handle'] = allocate_handle(
+            normalize_handle(shopify_product['product']['handle']), all_handles)
+        batch.append(shopify_product)
+
+    print(f"🚚 Пакетне створення через GraphQL: {len(batch)} товарів, {BULK_CREATE_CONCURRENCY} потоків")
+    created = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=BULK_CREATE_CONCURRENCY) as pool:
+        futures = {pool.submit(create_product_graphql, sp): sp for sp in batch}
+        for future in concurrent.futures.as_completed(futures):
+            shopify_product = futures[future]
+            try:
+                new_product = future.result()
+            except Exception as e:
+                print(f"❌ productSet: {e}")
+                new_product = None
+            if not new_product:
+                all_handles.discard(normalize_handle(shopify_product['product']['handle']))
+                fallback.append(shopify_product)
+                continue
+            existing_products.append(new_product)
+            all_skus.add(normalize_sku(new_product['variants'][0].get('sku')))
+            all_handles.add(normalize_handle(new_product.get('handle')))
+            created += 1
+            if on_created:
+                on_created(shopify_product)
+
+    if fallback:
+        print(f"↩️ Через REST (з обробкою 422): {len(fallback)} товарів")
+    for shopify_product in fallback:
+        if not send_to_shopify(shopify_product, existing_products, all_skus, all_handles):
+            continue
+        created += 1
+        if on_created:
+            on_created(shopify_product)
+    print(f"✅ Створено/оновлено: {created}/{len(shopify_products)}")
+    return created
+
+def create_products(shopify_products, existing_products, all_skus, all_handles, on_created=None):
+    """Великі партії — через GraphQL, поодинокі — звичним REST-шляхом."""
+    if len(shopify_products) >= BULK_CREATE_MIN_ITEMS:
+        return create_products_bulk(shopify_products, existing_products, all_skus, all_handles, on_created)
+    created = 0
+    for shopify_product in shopify_products:
+        if not send_to_shopify(shopify_product, existing_products, all_skus, all_handles):
+            continue
+        created += 1
+        if on_created:
+            on_created(shopify_product)
+    return created
 
 # ================== ЛОГІКА СИНХРОНІЗАЦІЇ ==================
-last_run_time = None  # для статусу
+run_metrics = {"throttled": 0, "min_headroom": None, "requests": {}, "phases": {}}  # поточний запуск (процес)
+_metrics_lock = threading.Lock()
+
+def reset_run_metrics():
+    with _metrics_lock:
+        run_metrics.update(throttled=0, min_headroom=None, requests={}, phases={})
+
+def count_request(endpoint):
+    with _metrics_lock:
+        run_metrics["requests"][endpoint] = run_metrics["requests"].get(endpoint, 0) + 1
+
+def count_throttled():
+    with _metrics_lock:
+        run_metrics["throttled"] += 1
+
+def record_phase(name, seconds):
+    with _metrics_lock:
+        run_metrics["phases"][name] = run_metrics["phases"].get(name, 0.0) + seconds
+
+def flush_run_counters(run_id):
+    """Лічильники процесу → спільні лічильники запуску (шардовані воркери рахують окремо)."""
+    with _metrics_lock:
+        counters = {f"requests:{k}": v for k, v in run_metrics["requests"].items()}
+        counters.update({f"phases:{k}": v for k, v in run_metrics["phases"].items()})
+        counters["throttled"] = run_metrics["throttled"]
+        min_headroom = run_metrics["min_headroom"]
+    with state_db() as conn:
+        for name, value in counters.items():
+            conn.execute(
+                """
+                INSERT INTO run_counters (run_id, name, value) VALUES (?, ?, ?)
+                ON CONFLICT(run_id, name) DO UPDATE SET value = value + excluded.value
+                """,
+                (run_id, name, value),
+            )
+        if min_headroom is not None:
+            # Запас rate limit не сумується — лишаємо найменший серед процесів
+            conn.execute(
+                """
+                INSERT INTO run_counters (run_id, name, value) VALUES (?, 'min_headroom', ?)
+                ON CONFLICT(run_id, name) DO UPDATE SET value = MIN(value, excluded.value)
+                """,
+                (run_id, min_headroom),
+            )
+
+def load_run_counters(run_id):
+    with state_db() as conn:
+        rows = conn.execute("SELECT name, value FROM run_counters WHERE run_id = ?", (run_id,)).fetchall()
+    requests_by_endpoint, phases, throttled, min_headroom = {}, {}, 0, None
+    for name, value in rows:
+        if name.startswith("requests:"):
+            requests_by_endpoint[name[len("requests:"):]] = int(value)
+        elif name.startswith("phases:"):
+            phases[name[len("phases:"):]] = round(value, 2)
+        elif name == "throttled":
+            throttled = int(value)
+        elif name == "min_headroom":
+            min_headroom = value
+    return requests_by_endpoint, phases, throttled, min_headroom
+
+def compute_adaptive_interval(current_minutes, runs):
+    """Новий інтервал (хв) і причина вибору за останніми запусками."""
+    if not runs:
+        return current_minutes, "немає історії запусків"
+
+    avg_duration_min = sum(r["duration_seconds"] for r in runs) / len(runs) / 60
+    change_ratio = sum(r["changed"] / r["total"] if r["total"] else 0 for r in runs) / len(runs)
+    headroom = runs[-1].get("min_headroom")
+    low_headroom = (headroom is not None and headroom < ADAPTIVE_MIN_HEADROOM) or runs[-1].get("throttled", 0) > 0
+
+    if change_ratio >= ADAPTIVE_HIGH_CHANGE_RATIO and not low_headroom:
+        proposed = current_minutes / 2
+        reason = f"багато змін ({change_ratio:.0%} SKU) — частіше"
+    elif change_ratio >= ADAPTIVE_HIGH_CHANGE_RATIO:
+        proposed = current_minutes
+        reason = f"багато змін ({change_ratio:.0%} SKU), але мало запасу rate limit — без змін"
+    elif change_ratio <= ADAPTIVE_LOW_CHANGE_RATIO:
+        proposed = current_minutes * 1.5
+        reason = f"мало змін ({change_ratio:.0%} SKU) — рідше"
+    else:
+        proposed = current_minutes
+        reason = f"помірні зміни ({change_ratio:.0%} SKU) — без змін"
+
+    # Між запусками лишаємо щонайменше дві їх тривалості
+    floor = max(ADAPTIVE_MIN_MINUTES, math.ceil(2 * avg_duration_min))
+    bounded = int(min(max(proposed, floor), max(ADAPTIVE_MAX_MINUTES, floor)))
+    if bounded != int(proposed):
+        reason = f"{reason}; обмежено межами {floor}–{max(ADAPTIVE_MAX_MINUTES, floor)} хв"
+    return bounded, reason
+
+def get_schedule():
+    """Поточний інтервал і причина вибору зі спільного сховища (лише в адаптивному режимі)."""
+    if not ADAPTIVE_SCHEDULE:
+        # Після вимкнення адаптивного режиму збережений інтервал більше не діє
+        return SCHEDULE_MINUTES, "базовий інтервал"
+    return (
+        get_state("interval_minutes", SCHEDULE_MINUTES),
+        get_state("interval_reason", "базовий інтервал"),
+    )
+
+def schedule_next_run(minutes):
+    """Наступний автозапуск = now + interval; процес-планувальник підхопить його на найближчому тіку."""
+    next_run = datetime.now(timezone.utc) + timedelta(minutes=minutes)
+    set_state(next_run_time=next_run.isoformat())
+    return next_run
+
+def update_adaptive_interval():
+    """Після запуску переобчислюємо інтервал (лише в адаптивному режимі)."""
+    if not ADAPTIVE_SCHEDULE:
+        return
+    current_minutes, _ = get_schedule()
+    runs = [run for run in load_runs(ADAPTIVE_HISTORY) if run["status"] == "finished"]
+    minutes, reason = compute_adaptive_interval(current_minutes, runs[::-1])
+    set_state(interval_minutes=minutes, interval_reason=reason)
+    print(f"🧮 Адаптивний інтервал: {minutes} хв ({reason})")
 
 def scheduled_sync():
     """Фонова синхронізація + фіксація часу запуску."""
-    global last_run_time
     with app.app_context():
         lock_file = acquire_sync_lock()
         if not lock_file:
@@ -359,7 +1224,7 @@ def scheduled_sync():
             return
         print("🔄 Запуск фонової синхронізації...")
         try:
-            last_run_time = datetime.now(timezone.utc)  # 👈 без deprecated utcnow()
+            set_state(last_run_time=datetime.now(timezone.utc).isoformat())  # 👈 без deprecated utcnow()
             result = sync_products()
             if is_success_response(result):
                 print("✅ Фонову синхронізацію завершено.")
@@ -367,17 +1232,32 @@ def scheduled_sync():
                 print("⚠️ Фонову синхронізацію завершено з помилкою. Наступний запуск буде за розкладом.")
         finally:
             release_sync_lock(lock_file)
-
-@app.route('/sync_products')
-def sync_products():
-    products = fetch_products()
-    existing_products = fetch_all_shopify_products()
-
-    if not products:
-        return jsonify({'status': 'No products found or an error occurred.'})
-    if existing_products is None:
-        return jsonify({'status': 'Shopify catalog fetch failed. Sync aborted.'}), 503
-
+            update_adaptive_interval()
+            schedule_next_run(get_schedule()[0])
+
+def write_scheduler_heartbeat():
+    set_state(scheduler_heartbeat=datetime.now(timezone.utc).isoformat())
+
+def scheduler_tick():
+    """Тік процесу-планувальника: запуск синку, якщо настав next_run_time."""
+    now = datetime.now(timezone.utc)
+    next_run = get_state("next_run_time")
+    if next_run is None:
+        # Перший старт: як і раніше, перший автозапуск — через повний інтервал
+        schedule_next_run(get_schedule()[0])
+        return
+    if now >= datetime.fromisoformat(next_run):
+        scheduled_sync()
+
+def is_scheduler_alive():
+    heartbeat = get_state("scheduler_heartbeat")
+    if not heartbeat:
+        return False
+    age = datetime.now(timezone.utc) - datetime.fromisoformat(heartbeat)
+    return age < timedelta(seconds=SCHEDULER_TICK_SECONDS * 3)
+
+def build_catalog_indexes(existing_products):
+    """Індекси SKU та handle по каталогу Shopify."""
     all_skus = {
         normalize_sku(v.get('sku'))
         for p in existing_products
@@ -389,21 +1269,509 @@ def sync_products():
         for p in existing_products
         if normalize_handle(p.get('handle'))
     }
+    return all_skus, all_handles
+
+def build_sku_index(existing_products):
+    """SKU -> варіант Shopify (для порівняння ціни й залишку)."""
+    index = {}
+    for p in existing_products:
+        for v in p.get('variants', []):
+            sku = normalize_sku(v.get('sku'))
+            if sku:
+                index.setdefault(sku, v)
+    return index
+
+def classify_change(shopify_product, existing_variant):
+    """Клас зміни для пріоритетної черги запису."""
+    if existing_variant is None:
+        return "create"
+
+    variant = shopify_product['product']['variants'][0]
+    new_quantity = variant['inventory_quantity']
+    old_quantity = existing_variant.get('inventory_quantity')
+    old_price = existing_variant.get('price')
+
+    if old_quantity is not None:
+        if new_quantity <= 0 < old_quantity:
+            return "out_of_stock"
+        if old_quantity > 0 and (old_quantity - new_quantity) / old_quantity >= STOCK_DROP_RATIO:
+            return "stock_drop"
+    if old_price is None or round(float(old_price), 2) != round(float(variant['price']), 2):
+        return "price"
+    if old_quantity is None or old_quantity != new_quantity:
+        return "stock"
+    return "unchanged"
+
+def record_propagation(stats, change_class, seconds):
+    entry = stats.setdefault(change_class, {"count": 0, "total_seconds": 0.0, "max_seconds": 0.0})
+    entry["count"] += 1
+    entry["total_seconds"] += seconds
+    entry["max_seconds"] = max(entry["max_seconds"], seconds)
+
+def flush_propagation_stats(run_id, stats):
+    """Додаємо метрики time-to-propagate процесу до спільних метрик запуску."""
+    if not stats:
+        return
+    now = time.time()
+    with state_db() as conn:
+        for change_class, entry in stats.items():
+            conn.execute(
+                """
+                INSERT INTO propagation_metrics (run_id, change_class, count, total_seconds, max_seconds, recorded_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT(run_id, change_class) DO UPDATE SET
+                    count = count + excluded.count,
+                    total_seconds = total_seconds + excluded.total_seconds,
+                    max_seconds = MAX(max_seconds, excluded.max_seconds),
+                    recorded_at = excluded.recorded_at
+                """,
+                (run_id, change_class, entry["count"], entry["total_seconds"], entry["max_seconds"], now),
+            )
+
+def get_propagation_report(run_id=None):
+    """Time-to-propagate по класах пріоритету для запуску (за замовчуванням — останнього)."""
+    with state_db() as conn:
+        if run_id is None:
+            row = conn.execute(
+                "SELECT run_id FROM propagation_metrics ORDER BY recorded_at DESC LIMIT 1"
+            ).fetchone()
+            if not row:
+                return {}
+            run_id = row[0]
+        rows = conn.execute(
+            "SELECT change_class, count, total_seconds, max_seconds FROM propagation_metrics WHERE run_id = ?",
+            (run_id,),
+        ).fetchall()
+    return {
+        change_class: {
+            "count": count,
+            "avg_seconds": round(total / count, 2) if count else 0.0,
+            "max_seconds": round(max_seconds, 2),
+        }
+        for change_class, count, total, max_seconds in rows
+    }
 
-    print(f"Знайдено товарів в 1С: {len(products)}")
-    for product in products:
+def process_products(products, existing_products, all_skus, all_handles, heartbeat=None,
+                     started_at=None, stats=None):
+    """Мапінг, пріоритезація і запис у Shopify. heartbeat() -> False зупиняє обробку (втрачено lease)."""
+    started_at = started_at if started_at is not None else time.monotonic()
+    stats = stats if stats is not None else {}
+    diff_started = time.monotonic()
+    sku_index = build_sku_index(existing_products)
+
+    # Спершу — обнулення й великі падіння залишків, потім ціни, потім створення
+    queue = []
+    for seq, product in enumerate(products):
         if not isinstance(product, dict):
             print(f"Пропуск некоректного запису: {product}")
             continue
 
         shopify_product = transform_to_shopify_format(product)
-        if shopify_product:
-            send_to_shopify(shopify_product, existing_products, all_skus, all_handles)
-        else:
+        if not shopify_product:
             print(f"Пропуск без 'ТОВ' ціни: {product.get('id', 'невідомий ID')}")
+            continue
+
+        sku = normalize_sku(shopify_product['product']['variants'][0]['sku'])
+        change_class = classify_change(shopify_product, sku_index.get(sku))
+        weight = PRIORITY_WEIGHTS.get(change_class, max(PRIORITY_WEIGHTS.values()))
+        heapq.heappush(queue, (weight, seq, change_class, shopify_product))
+
+    # Багато нових товарів — створюємо однією паралельною партією, коли черга дійде до їхнього пріоритету
+    creates = [item for item in queue if item[2] == "create"]
+    if len(creates) >= BULK_CREATE_MIN_ITEMS:
+        queue = [item for item in queue if item[2] != "create"]
+        heapq.heapify(queue)
+    else:
+        creates = []
+    create_weight = PRIORITY_WEIGHTS.get("create", max(PRIORITY_WEIGHTS.values()))
+    record_phase("diff", time.monotonic() - diff_started)
+
+    print(f"📋 Черга запису: {len(queue) + len(creates)} товарів")
+    write_started = time.monotonic()
+    try:
+        return write_queue(queue, creates, create_weight, existing_products, all_skus, all_handles,
+                           heartbeat, started_at, stats)
+    finally:
+        record_phase("write", time.monotonic() - write_started)
+
+def write_queue(queue, creates, create_weight, existing_products, all_skus, all_handles, heartbeat, started_at, stats):
+    """Запис пріоритетної черги (creates — окрема партія для пакетного створення)."""
+    lease_ok = True
+    while queue or creates:
+        if creates and (not queue or queue[0][0] >= create_weight):
+            def on_created(_shopify_product):
+                nonlocal lease_ok
+                record_propagation(stats, "create", time.monotonic() - started_at)
+                if heartbeat and not heartbeat():
+                    lease_ok = False
+
+            create_products([item[3] for item in creates], existing_products, all_skus, all_handles, on_created)
+            creates = []
+            if not lease_ok:
+                return False
+            continue
+
+        _, _, change_class, shopify_product = heapq.heappop(queue)
+        if send_to_shopify(shopify_product, existing_products, all_skus, all_handles):
+            record_propagation(stats, change_class, time.monotonic() - started_at)
+
+        if heartbeat and not heartbeat():
+            return False
+
+    drain_deferred_requests(max_wait=DEFERRED_DRAIN_MAX_SECONDS, heartbeat=heartbeat)
+    discard_deferred_requests()
+    # Очікування breaker-ів може тривати довше за TTL lease — шард завершений, лише якщо lease ще наш
+    return not heartbeat or heartbeat()
 
+def run_shard_worker(worker_index, products, existing_products, shard_count, run_id, started_at=None,
+                     lease_run_id=None):
+    """Воркер: по черзі захоплює вільні шарди і синхронізує їхні SKU.
+
+    run_id — запуск цього хоста (метрики, історія), lease_run_id — спільний для хостів запуск (leases).
+    """
+    lease_run_id = lease_run_id or run_id
+    owner = f"{socket.gethostname()}:{os.getpid()}:{worker_index}"
+    reset_run_metrics()
+    by_shard = {}
+    for product in products:
+        sku = product.get('id') if isinstance(product, dict) else None
+        by_shard.setdefault(shard_for_sku(sku, shard_count), []).append(product)
+
+    all_skus, all_handles = build_catalog_indexes(existing_products)
+    all_handles = SharedHandleSet(all_handles, lease_run_id)
+    stats = {}
+    processed = []
+    # Зсув старту, щоб воркери не билися за ті самі шарди
+    for offset in range(shard_count):
+        shard = (worker_index + offset) % shard_count
+        if not acquire_shard_lease(shard, owner, lease_run_id):
+            continue
+        shard_products = by_shard.get(shard, [])
+        print(f"🧩 [{owner}] Шард {shard}/{shard_count}: {len(shard_products)} товарів")
+        try:
+            finished = process_products(
+                shard_products, existing_products, all_skus, all_handles,
+                heartbeat=lambda: acquire_shard_lease(shard, owner, lease_run_id),
+                started_at=started_at, stats=stats,
+            )
+        except Exception:
+            release_shard_lease(shard, owner)
+            flush_propagation_stats(run_id, stats)
+            flush_run_counters(run_id)
+            raise
+        if finished and complete_shard_lease(shard, owner):
+            processed.append(shard)
+        else:
+            print(f"⚠️ [{owner}] Lease шарда {shard} втрачено — шард дообробить інший воркер.")
+    flush_propagation_stats(run_id, stats)
+    flush_run_counters(run_id)
+    return processed
+
+def run_sharded_sync(products, existing_products, shard_count=None, workers=None, run_id=None, started_at=None):
+    """Паралельний синк: K шардів на N процесах зі спільним rate budget."""
+    shard_count = shard_count or SYNC_SHARDS
+    workers = max(1, min(workers or SYNC_WORKERS, shard_count))
+    run_id = run_id or uuid.uuid4().hex
+    # Хости, що синхронізують одночасно, ділять шарди одного спільного запуску
+    lease_run_id = join_shard_run(shard_count)
+    print(f"🧩 Шардований синк: {shard_count} шардів, {workers} процесів, run_id={run_id}, "
+          f"спільний запуск={lease_run_id}")
+
+    # forkserver, а не fork: синк запускається і з багатопотокового web-воркера, де fork
+    # може успадкувати лок (_metrics_lock, _breakers_lock), захоплений іншим потоком
+    ctx = multiprocessing.get_context("forkserver")
+    processes = [
+        ctx.Process(
+            target=run_shard_worker,
+            args=(i, products, existing_products, shard_count, run_id, started_at, lease_run_id),
+            name=f"sync-shard-worker-{i}",
+        )
+        for i in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+    failed = [p.name for p in processes if p.exitcode != 0]
+    if failed:
+        print(f"❌ Воркери завершились з помилкою: {failed}")
+    return not failed
+
+@app.route('/sync_products')
+def sync_products():
+    run_id = uuid.uuid4().hex
+    started_at = time.monotonic()
+    started_at_utc = datetime.now(timezone.utc)
+    reset_run_metrics()
+    reset_retry_policy()
+
+    phase_started = time.monotonic()
+    products = fetch_products()
+    record_phase("fetch_1c", time.monotonic() - phase_started)
+    phase_started = time.monotonic()
+    existing_products = fetch_all_shopify_products()
+    record_phase("fetch_shopify", time.monotonic() - phase_started)
+
+    if not products:
+        finish_run(run_id, "no_products", 0, started_at, started_at_utc)
+        return jsonify({'status': 'No products found or an error occurred.'})
+    if existing_products is None:
+        finish_run(run_id, "aborted", 0, started_at, started_at_utc)
+        return jsonify({'status': 'Shopify catalog fetch failed. Sync aborted.'}), 503
+
+    print(f"Знайдено товарів в 1С: {len(products)}")
+    if SYNC_SHARDS > 1:
+        phase_started = time.monotonic()
+        ok = run_sharded_sync(products, existing_products, run_id=run_id, started_at=started_at)
+        record_phase("shards", time.monotonic() - phase_started)
+    else:
+        all_skus, all_handles = build_catalog_indexes(existing_products)
+        stats = {}
+        try:
+            process_products(products, existing_products, all_skus, all_handles, started_at=started_at, stats=stats)
+        except Exception:
+            finish_run(run_id, "failed", len(products), started_at, started_at_utc)
+            raise
+        finally:
+            flush_propagation_stats(run_id, stats)
+        ok = True
+
+    finish_run(run_id, "finished" if ok else "failed", len(products), started_at, started_at_utc)
+    if not ok:
+        return jsonify({'status': 'Sharded sync failed in one or more workers.'}), 500
     return jsonify({'status': 'finished'})
 
+# ================== ІСТОРІЯ ЗАПУСКІВ ==================
+def finish_run(run_id, status, items, started_at, started_at_utc):
+    """Записуємо запуск в історію: фази, запити по endpoint-ах, 429, throughput, регресія."""
+    duration = time.monotonic() - started_at
+    flush_run_counters(run_id)
+    requests_by_endpoint, phases, throttled, min_headroom = load_run_counters(run_id)
+    classes = get_propagation_report(run_id)
+    written = sum(entry["count"] for entry in classes.values())
+    changed = written - classes.get("unchanged", {}).get("count", 0)
+    throughput = items / duration if duration > 0 else 0.0
+
+    baseline = None
+    regression = False
+    if status == "finished":
+        previous = [r["throughput"] for r in load_runs(RUN_BASELINE_WINDOW) if r["status"] == "finished"]
+        if len(previous) >= RUN_BASELINE_MIN_RUNS:
+            baseline = statistics.median(previous)
+            regression = throughput < baseline * (1 - RUN_REGRESSION_THRESHOLD)
+    if regression:
+        print(f"🐢 Регресія продуктивності: {throughput:.2f} тов/с проти базових {baseline:.2f} тов/с")
+
+    with state_db() as conn:
+        conn.execute(
+            """
+            INSERT OR REPLACE INTO sync_runs (
+                run_id, started_at, finished_at, status, duration_seconds, items, changed, throughput,
+                throttled, min_headroom, phases, requests, baseline_throughput, regression
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            (
+                run_id, started_at_utc.isoformat(), datetime.now(timezone.utc).isoformat(), status,
+                duration, items, changed, throughput, throttled, min_headroom,
+                json.dumps(phases), json.dumps(requests_by_endpoint), baseline, int(regression),
+            ),
+        )
+
+def load_runs(limit=50):
+    """Останні запуски, від найновішого."""
+    with state_db() as conn:
+        conn.row_factory = sqlite3.Row
+        rows = conn.execute(
+            "SELECT * FROM sync_runs ORDER BY started_at DESC LIMIT ?", (limit,)
+        ).fetchall()
+    runs = []
+    for row in rows:
+        run = dict(row)
+        run["phases"] = json.loads(run["phases"])
+        run["requests"] = json.loads(run["requests"])
+        run["regression"] = bool(run["regression"])
+        run["total"] = run["items"]
+        runs.append(run)
+    return runs
+
+@app.route("/runs")
+def runs():
+    limit = min(request.args.get("limit", 50, type=int), 500)
+    return jsonify({"runs": load_runs(limit)})
+
+# ================== DRY-RUN ПЛАН ==================
+def estimate_plan_seconds(rest_calls, graphql_calls, headroom=None):
+    """Оцінка тривалості запису: REST і GraphQL мають окремі бюджети.
+
+    headroom — виміряний вільний запас REST-бакета (0..1): коли бакет ділимо з іншими
+    застосунками, нам лишається пропорційна частка його відновлення.
+    """
+    rest_interval = SHOPIFY_MIN_REQUEST_INTERVAL
+    if headroom is not None:
+        rest_interval /= max(headroom, ADAPTIVE_MIN_HEADROOM)
+    return rest_calls * rest_interval + graphql_calls * SHOPIFY_GRAPHQL_MIN_REQUEST_INTERVAL
+
+def build_plan(products, existing_products, headroom=None):
+    """Fetch/index/diff без запису: рядок-підсумок + дії в порядку пріоритету."""
+    sku_index = build_sku_index(existing_products)
+    _, all_handles = build_catalog_indexes(existing_products)
+    planned_handles = set(all_handles)
+
+    actions = []
+    skips = []
+    for seq, product in enumerate(products):
+        if not isinstance(product, dict):
+            skips.append({"action": "skip", "reason": "invalid_record"})
+            continue
+
+        shopify_product = transform_to_shopify_format(product)
+        if not shopify_product:
+            skips.append({"action": "skip", "reason": "no_tov_price", "sku": normalize_sku(product.get('id'))})
+            continue
+
+        variant_data = shopify_product['product']['variants'][0]
+        sku = normalize_sku(variant_data['sku'])
+        existing_variant = sku_index.get(sku)
+        change_class = classify_change(shopify_product, existing_variant)
+        weight = PRIORITY_WEIGHTS.get(change_class, max(PRIORITY_WEIGHTS.values()))
+
+        if existing_variant is None:
+            handle = allocate_handle(normalize_handle(shopify_product['product']['handle']), planned_handles)
+            actions.append((weight, seq, {
+                "action": "create", "priority": change_class, "sku": sku, "handle": handle,
+                "product": {**shopify_product['product'], "handle": handle},
+            }))
+            continue
+
+        old_price = existing_variant.get('price')
+        old_quantity = existing_variant.get('inventory_quantity')
+        price_changed = old_price is None or round(float(old_price), 2) != round(float(variant_data['price']), 2)
+        quantity_changed = old_quantity is None or old_quantity != variant_data['inventory_quantity']
+        if price_changed:
+            actions.append((weight, seq, {
+                "action": "update_price", "priority": change_class, "sku": sku,
+                "variant_id": existing_variant['id'],
+                "old_price": old_price, "new_price": variant_data['price'],
+            }))
+        if quantity_changed:
+            actions.append((weight, seq, {
+                "action": "update_quantity", "priority": change_class, "sku": sku,
+                "variant_id": existing_variant['id'],
+                "inventory_item_id": existing_variant.get('inventory_item_id'),
+                "old_quantity": old_quantity, "new_quantity": variant_data['inventory_quantity'],
+            }))
+        if not price_changed and not quantity_changed:
+            skips.append({"action": "skip", "reason": "unchanged", "sku": sku})
+
+    actions.sort(key=lambda item: (item[0], item[1]))
+    rows = [row for _, _, row in actions] + skips
+
+    counts = {}
+    for row in rows:
+        counts[row["action"]] = counts.get(row["action"], 0) + 1
+    # Великі партії створень ідуть через GraphQL productSet (див. create_products)
+    create_count = counts.get("create", 0)
+    graphql_calls = create_count if create_count >= BULK_CREATE_MIN_ITEMS else 0
+    rest_calls = len(actions) - graphql_calls
+    summary = {
+        "action": "summary",
+        "generated_at": datetime.now(timezone.utc).isoformat(),
+        "counts": counts,
+        "estimated_api_calls": len(actions),
+        "estimated_rest_calls": rest_calls,
+        "estimated_graphql_calls": graphql_calls,
+        "rate_limit_headroom": headroom,
+        "estimated_seconds": round(estimate_plan_seconds(rest_calls, graphql_calls, headroom), 1),
+    }
+    return [summary] + rows
+
+def plan_sync():
+    """Повертає (план, None) або (None, (повідомлення, код)). Викликати під sync lock."""
+    reset_run_metrics()
+    products = fetch_products()
+    if not products:
+        return None, ('No products found or an error occurred.', 200)
+    existing_products = fetch_all_shopify_products()
+    if existing_products is None:
+        return None, ('Shopify catalog fetch failed. Plan aborted.', 503)
+    # Запас rate limit, виміряний щойно під час збору каталогу; без відповідей — з останнього запуску
+    headroom = run_metrics["min_headroom"]
+    if headroom is None:
+        headroom = next((r["min_headroom"] for r in load_runs(1)), None)
+    return build_plan(products, existing_products, headroom), None
+
+def iter_plan_jsonl(plan):
+    for row in plan:
+        yield json.dumps(row, ensure_ascii=False) + "\n"
+
+def read_plan_jsonl(lines):
+    return [json.loads(line) for line in lines if line.strip()]
+
+def execute_plan(plan):
+    """Виконує збережений план як є, без повторного збору 1С/Shopify."""
+    reset_retry_policy()
+    done = {"create": 0, "update_price": 0, "update_quantity": 0, "failed": 0}
+    creates = []
+    for row in plan:
+        action = row.get("action")
+        if action == "update_price":
+            ok = update_variant_price(row["variant_id"], row["new_price"])
+        elif action == "update_quantity":
+            ok = update_variant_quantity(row["variant_id"], row["inventory_item_id"], row["new_quantity"])
+        elif action == "create":
+            creates.append({"product": row["product"]})
+            continue
+        else:
+            continue
+        done[action if ok else "failed"] += 1
+
+    if creates:
+        done["create"] = create_products(creates, [], set(), set())
+        done["failed"] += len(creates) - done["create"]
+    drain_deferred_requests(max_wait=DEFERRED_DRAIN_MAX_SECONDS)
+    discard_deferred_requests()
+    print(f"📋 План виконано: {done}")
+    return done
+
+@app.route("/plan")
+def plan():
+    """Dry-run: JSONL-план змін (перший рядок — підсумок з оцінкою вартості)."""
+    # Під lock-ом: план скидає метрики процесу й оновлює знімок каталогу — як і синк
+    lock_file = acquire_sync_lock()
+    if not lock_file:
+        return jsonify({"ok": False, "message": "Синхронізація вже виконується. Спробуйте через хвилину."}), 409
+    try:
+        plan_rows, error = plan_sync()
+    finally:
+        release_sync_lock(lock_file)
+    if error:
+        message, code = error
+        return jsonify({'status': message}), code
+    filename = f"sync-plan-{datetime.now(timezone.utc):%Y%m%dT%H%M%SZ}.jsonl"
+    return Response(
+        iter_plan_jsonl(plan_rows),
+        mimetype="application/x-ndjson",
+        headers={"Content-Disposition": f"attachment; filename={filename}"},
+    )
+
+@app.route("/plan/execute", methods=["POST"])
+def plan_execute():
+    """Виконання раніше збереженого JSONL-плану (тіло запиту)."""
+    try:
+        plan_rows = read_plan_jsonl(request.get_data(as_text=True).splitlines())
+    except json.JSONDecodeError as e:
+        return jsonify({"ok": False, "message": f"Некоректний план: {e}"}), 400
+
+    lock_file = acquire_sync_lock()
+    if not lock_file:
+        return jsonify({"ok": False, "message": "Синхронізація вже виконується. Спробуйте через хвилину."}), 409
+    try:
+        done = execute_plan(plan_rows)
+    finally:
+        release_sync_lock(lock_file)
+    return jsonify({"ok": True, "done": done})
+
 # ================== ВЕБ-ІНТЕРФЕЙС (UA, MIXOpro.Ukraine) ==================
 INDEX_HTML = """
 <!doctype html>
@@ -487,6 +1855,11 @@ INDEX_HTML = """
       white-space: pre; overflow-x: auto; /* 👈 на мобилках можно скроллить лог */
       margin-top: 14px; padding-bottom: 4px;
     }
+    .runs { width: 100%; border-collapse: collapse; margin-top: 12px; font-size: 13px; }
+    .runs th, .runs td { text-align: left; padding: 6px 8px; border-bottom: 1px solid var(--border); white-space: nowrap; }
+    .runs th { color: var(--muted); font-weight: 600; }
+    .runs tr.regression td { color: var(--danger); }
+    .table-scroll { overflow-x: auto; }
     footer { margin: 36px 0; text-align: center; color: var(--muted); padding-bottom: env(safe-area-inset-bottom); }
 
     /* ====== Мобильная адаптация ====== */
@@ -538,7 +1911,7 @@ INDEX_HTML = """
     <section class="card">
       <div class="inner">
         <h1>Керування синхронізацією</h1>
-        <p class="muted">Запускайте оновлення вручну. Автосинхронізація працює кожні {{ schedule_minutes }} хв.</p>
+        <p class="muted">Запускайте оновлення вручну. Автосинхронізація працює кожні <span id="subtitle-interval">{{ interval_minutes }}</span> хв.</p>
 
         <div class="actions">
           <button id="run" class="btn-primary">🚀 Запустити зараз</button>
@@ -554,18 +1927,39 @@ INDEX_HTML = """
             <div class="label">Останній запуск</div>
             <div class="value"><span id="kpi-last">—</span></div>
           </div>
+          <div class="kpi">
+            <div class="label">Поточний інтервал</div>
+            <div class="value"><span id="kpi-interval">—</span></div>
+          </div>
         </div>
 
         <div id="status" class="mono" aria-live="polite">Завантажую статус…</div>
       </div>
     </section>
 
+    <section class="card" style="margin-top:16px;">
+      <div class="inner">
+        <h1>Історія запусків</h1>
+        <p class="muted">Тривалість, throughput і 429 за останні запуски. 🐢 — throughput нижчий за базовий рівень.</p>
+        <div class="table-scroll">
+          <table class="runs">
+            <thead>
+              <tr><th>Початок</th><th>Статус</th><th>Тривалість</th><th>Товарів</th><th>Змін</th><th>тов/с</th><th>Запитів</th><th>429</th></tr>
+            </thead>
+            <tbody id="runs"><tr><td colspan="8">Завантажую…</td></tr></tbody>
+          </table>
+        </div>
+      </div>
+    </section>
+
     <footer>© {{ year }} MIXOpro.Ukraine — Синхронізація 1С ↔ Shopify</footer>
   </main>
 
   <script>
     const elStatus = document.getElementById('status');
     const elKpiLast = document.getElementById('kpi-last');
+    const elKpiInterval = document.getElementById('kpi-interval');
+    const elSubtitleInterval = document.getElementById('subtitle-interval');
 
     function fmt(ts) { return ts ? new Date(ts).toLocaleString() : '—'; }
 
@@ -573,11 +1967,29 @@ INDEX_HTML = """
       const r = await fetch('/status');
       const j = await r.json();
       elStatus.textContent =
-        `Задача планувальника: ${j.job_exists ? 'активна' : 'відсутня'}\nОстанній запуск: ${fmt(j.last_run_time)}`;
+        `Задача планувальника: ${j.job_exists ? 'активна' : 'відсутня'}\nОстанній запуск: ${fmt(j.last_run_time)}` +
+        `\nНаступний запуск: ${fmt(j.next_run_time)}` +
+        `\nІнтервал: ${j.interval_minutes} хв (${j.adaptive ? 'адаптивний' : 'фіксований'}) — ${j.interval_reason}`;
       elKpiLast.textContent = fmt(j.last_run_time);
+      elKpiInterval.textContent = `${j.interval_minutes} хв`;
+      elSubtitleInterval.textContent = j.interval_minutes;
+    }
+
+    async function loadRuns() {
+      const r = await fetch('/runs?limit=20');
+      const j = await r.json();
+      const rows = j.runs.map(run => {
+        const requests = Object.values(run.requests).reduce((a, b) => a + b, 0);
+        return `<tr class="${run.regression ? 'regression' : ''}">` +
+          `<td>${fmt(run.started_at)}</td><td>${run.status}</td>` +
+          `<td>${(run.duration_seconds / 60).toFixed(1)} хв</td><td>${run.items}</td><td>${run.changed}</td>` +
+          `<td>${run.throughput.toFixed(2)}${run.regression ? ' 🐢' : ''}</td>` +
+          `<td>${requests}</td><td>${run.throttled}</td></tr>`;
+      });
+      document.getElementById('runs').innerHTML = rows.join('') || '<tr><td colspan="8">Ще немає запусків</td></tr>';
     }
 
-    document.getElementById('refresh').addEventListener('click', loadStatus);
+    document.getElementById('refresh').addEventListener('click', () => { loadStatus(); loadRuns(); });
 
     document.getElementById('run').addEventListener('click', async () => {
       const btn = document.getElementById('run');
@@ -591,10 +2003,12 @@ INDEX_HTML = """
       } finally {
         btn.disabled = false; btn.textContent = '🚀 Запустити зараз';
         loadStatus();
+        loadRuns();
       }
     });
 
     loadStatus();
+    loadRuns();
   </script>
 </body>
 </html>
@@ -602,16 +2016,21 @@ INDEX_HTML = """
 
 @app.route("/")
 def index():
-    return render_template_string(INDEX_HTML, schedule_minutes=SCHEDULE_MINUTES, year=datetime.utcnow().year)
+    return render_template_string(
+        INDEX_HTML, schedule_minutes=SCHEDULE_MINUTES, interval_minutes=get_schedule()[0], year=datetime.utcnow().year)
 
 @app.route("/status")
 def status():
-    job = scheduler.get_job(JOB_ID)
-    next_run = job.next_run_time if job else None
+    # Усе читаємо зі спільного сховища — відповідь однакова для будь-якого web-воркера
+    interval_minutes, reason = get_schedule()
     return jsonify({
-        "last_run_time": last_run_time.isoformat() if last_run_time else None,  # 👈 tz-aware ISO
-        "next_run_time": next_run.astimezone(timezone.utc).isoformat() if next_run else None,
-        "job_exists": bool(job)
+        "last_run_time": get_state("last_run_time"),  # 👈 tz-aware ISO
+        "next_run_time": get_state("next_run_time"),
+        "job_exists": is_scheduler_alive(),
+        "adaptive": ADAPTIVE_SCHEDULE,
+        "interval_minutes": interval_minutes,
+        "interval_reason": reason,
+        "propagation": get_propagation_report(),
     })
 
 @app.route("/run_sync", methods=["POST"])
@@ -622,9 +2041,8 @@ def run_sync():
         return jsonify({"ok": False, "message": "Синхронізація вже виконується. Спробуйте через хвилину."}), 409
 
     try:
-        global last_run_time
         print("🔄 Ручний запуск синхронізації...")
-        last_run_time = datetime.now(timezone.utc)
+        set_state(last_run_time=datetime.now(timezone.utc).isoformat())
         result = sync_products()
         if is_success_response(result):
             print("✅ Ручну синхронізацію завершено.")
@@ -639,39 +2057,92 @@ def run_sync():
     finally:
         release_sync_lock(lock_file)
 
-    # 👇 Надійний спосіб: пересоздаємо тригер зі start_date = now + interval
-    next_start = datetime.now(timezone.utc) + timedelta(minutes=SCHEDULE_MINUTES)
-    new_trigger = IntervalTrigger(
-        minutes=SCHEDULE_MINUTES,
-        start_date=next_start,
-        timezone=timezone.utc,
-    )
-
-    job = scheduler.get_job(JOB_ID)
-    if job:
-        job.reschedule(new_trigger)
-        msg = f"{msg} Наступний автозапуск через {SCHEDULE_MINUTES} хв."
-    else:
-        scheduler.add_job(func=scheduled_sync, trigger=new_trigger, id=JOB_ID, replace_existing=True)
-        msg = f"{msg} Задачу планувальника створено заново."
+    update_adaptive_interval()
+    interval_minutes, _ = get_schedule()
+    schedule_next_run(interval_minutes)
+    msg = f"{msg} Наступний автозапуск через {interval_minutes} хв."
+    if not is_scheduler_alive():
+        msg = f"{msg} ⚠️ Процес планувальника не відповідає."
     return jsonify({"ok": ok, "message": msg}), code
 
 # ================== APSCHEDULER ==================
-executors = {'default': ThreadPoolExecutor(20)}
-scheduler = BackgroundScheduler(
-    executors=executors,
-    timezone=timezone.utc,
-    job_defaults={"coalesce": True, "misfire_grace_time": 300, "max_instances": 1},
-)
-
-initial_trigger = IntervalTrigger(
-    minutes=SCHEDULE_MINUTES,
-    start_date=datetime.now(timezone.utc) + timedelta(minutes=SCHEDULE_MINUTES),
-    timezone=timezone.utc,
-)
-scheduler.add_job(func=scheduled_sync, trigger=initial_trigger, id=JOB_ID, replace_existing=True)
-scheduler.start()
+scheduler = None
+
+def start_scheduler(blocking=False):
+    """Планувальник запускається явно: окремим процесом (--scheduler) або вбудованим у dev-режимі."""
+    global scheduler
+    scheduler_class = BlockingScheduler if blocking else BackgroundScheduler
+    # Два потоки: тік може годинами виконувати синк, heartbeat при цьому не має зупинятися
+    scheduler = scheduler_class(
+        executors={'default': ThreadPoolExecutor(2)},
+        timezone=timezone.utc,
+        job_defaults={"coalesce": True, "misfire_grace_time": 300, "max_instances": 1},
+    )
+    scheduler.add_job(
+        func=scheduler_tick,
+        trigger=IntervalTrigger(seconds=SCHEDULER_TICK_SECONDS, timezone=timezone.utc),
+        id=JOB_ID,
+        next_run_time=datetime.now(timezone.utc),
+        replace_existing=True,
+    )
+    scheduler.add_job(
+        func=write_scheduler_heartbeat,
+        trigger=IntervalTrigger(seconds=SCHEDULER_TICK_SECONDS, timezone=timezone.utc),
+        id=HEARTBEAT_JOB_ID,
+        next_run_time=datetime.now(timezone.utc),
+        replace_existing=True,
+    )
+    print(f"⏰ Планувальник запущено (тік {SCHEDULER_TICK_SECONDS} с, сховище стану: {STATE_DB_PATH})")
+    scheduler.start()
+    return scheduler
 
 # ================== ENTRYPOINT ==================
-if __name__ == '__main__':
+def main():
+    parser = argparse.ArgumentParser(description="MIXOpro.Ukraine — синхронізація 1С ↔ Shopify")
+    parser.add_argument("--plan", metavar="PATH", help="dry-run: зберегти JSONL-план змін і вийти")
+    parser.add_argument("--execute-plan", metavar="PATH", help="виконати збережений JSONL-план і вийти")
+    parser.add_argument("--scheduler", action="store_true",
+                        help="лише процес-планувальник (web — окремо: gunicorn -c gunicorn.conf.py wsgi:app)")
+    args = parser.parse_args()
+
+    if args.plan:
+        lock_file = acquire_sync_lock()
+        if not lock_file:
+            print("⏭️ Синхронізація вже виконується в іншому процесі.")
+            return 1
+        try:
+            plan_rows, error = plan_sync()
+        finally:
+            release_sync_lock(lock_file)
+        if error:
+            print(f"❌ {error[0]}")
+            return 1
+        with open(args.plan, "w", encoding="utf-8") as fp:
+            fp.writelines(iter_plan_jsonl(plan_rows))
+        print(f"📋 План збережено: {args.plan} | {plan_rows[0]['counts']}")
+        return 0
+    if args.execute_plan:
+        lock_file = acquire_sync_lock()
+        if not lock_file:
+            print("⏭️ Синхронізація вже виконується в іншому процесі.")
+            return 1
+        try:
+            with open(args.execute_plan, encoding="utf-8") as fp:
+                execute_plan(read_plan_jsonl(fp))
+        finally:
+            release_sync_lock(lock_file)
+        return 0
+    if args.scheduler:
+        try:
+            start_scheduler(blocking=True)
+        except (KeyboardInterrupt, SystemExit):
+            pass
+        return 0
+
+    # Dev-режим: один процес із вбудованим планувальником
+    start_scheduler()
     app.run(host='0.0.0.0', port=80, debug=False)
+    return 0
+
+if __name__ == '__main__':
+    raise SystemExit(main())
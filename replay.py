@@ -0,0 +1,357 @@
+"""Запис і відтворення трафіку 1С/Shopify для офлайн-перевірки синхронізації.
+
+    python replay.py record capture.jsonl [--mode sync|plan]
+    python replay.py replay capture.jsonl [--speed 10] [--engine main:sync_products]
+    python replay.py ab capture.jsonl --candidate my_engine:sync_products [--speed 0]
+
+record — реальний запуск (sync пише в Shopify, plan — лише читає) з записом кожної
+відповіді в JSONL; токени не пишуться, адреси 1С/магазину замінюються плейсхолдерами.
+replay — той самий рушій проти записаних відповідей; --speed 1 відтворює записані
+затримки, 10 — вдесятеро швидше, 0 — без затримок (разом із локальним rate budget).
+ab — базовий і кандидатський рушій на одному записі: час, запити, розбіжність записів.
+"""
+import argparse
+import base64
+import importlib
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from unittest import mock
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+import httpx
+import requests
+import requests.adapters
+from requests.structures import CaseInsensitiveDict
+
+import main
+
+SHOPIFY_PLACEHOLDER = "https://shop.invalid"
+ONE_C_PLACEHOLDER = "https://1c.invalid/goods"
+# Лише ці заголовки відповіді потрібні рушію; решта (cookies, request-id) не пишеться
+RECORDED_HEADERS = ("Content-Type", "Link", "Retry-After", "X-Shopify-Shop-Api-Call-Limit")
+SECRET_QUERY_PARAMS = {"access_token", "token", "key", "password", "signature"}
+
+
+# ================== РЕДАГУВАННЯ СЕКРЕТІВ ==================
+def redact_text(text):
+    """Реальні адреси 1С і магазину → плейсхолдери."""
+    if not text:
+        return text
+    if main.url:
+        text = text.replace(main.url, ONE_C_PLACEHOLDER)
+    if main.shopify_store_url:
+        text = text.replace(main.shopify_store_url.rstrip("/"), SHOPIFY_PLACEHOLDER)
+    return text
+
+
+def redact_url(url):
+    parts = urlsplit(redact_text(url))
+    netloc = parts.netloc.rsplit("@", 1)[-1]  # user:password@host
+    query = urlencode([
+        (name, "REDACTED" if name.lower() in SECRET_QUERY_PARAMS else value)
+        for name, value in parse_qsl(parts.query, keep_blank_values=True)
+    ])
+    return urlunsplit((parts.scheme, netloc, parts.path, query, parts.fragment))
+
+
+def request_json(body):
+    """Тіло запиту (bytes/str) → JSON, як його передав рушій."""
+    if not body:
+        return None
+    if isinstance(body, bytes):
+        body = body.decode("utf-8", errors="replace")
+    try:
+        return json.loads(body)
+    except ValueError:
+        return redact_text(body)
+
+
+def source_for(url):
+    return "1c" if url.startswith(ONE_C_PLACEHOLDER) else "shopify"
+
+
+def encode_body(content):
+    try:
+        return {"body": redact_text(content.decode("utf-8"))}
+    except UnicodeDecodeError:
+        return {"body_b64": base64.b64encode(content).decode("ascii")}
+
+
+def decode_body(entry):
+    if "body_b64" in entry:
+        return base64.b64decode(entry["body_b64"])
+    return (entry.get("body") or "").encode("utf-8")
+
+
+# ================== ЗАПИС ==================
+class CaptureWriter:
+    def __init__(self, fp):
+        self.fp = fp
+        self.started = time.monotonic()
+        self.seq = 0
+        # Пакетне створення (GraphQL) пише з кількох потоків одночасно
+        self._lock = threading.Lock()
+
+    def write(self, method, url, json_data, started, response=None, error=None):
+        url = redact_url(url)
+        entry = {
+            "t": round(started - self.started, 4),
+            "elapsed": round(time.monotonic() - started, 4),
+            "source": source_for(url),
+            "method": method,
+            "url": url,
+            "request": json_data,
+        }
+        if error is not None:
+            entry["error"] = f"{type(error).__name__}: {redact_text(str(error))}"
+        else:
+            entry["status"] = response.status_code
+            entry["headers"] = {
+                name: redact_text(response.headers[name]) for name in RECORDED_HEADERS if name in response.headers
+            }
+            entry.update(encode_body(response.content))
+        with self._lock:
+            self.seq += 1
+            self.fp.write(json.dumps({"seq": self.seq, **entry}, ensure_ascii=False) + "\n")
+            self.fp.flush()
+
+
+@contextmanager
+def recording(fp):
+    """Пише кожну відповідь 1С/Shopify у fp.
+
+    Патчимо транспорт (HTTPAdapter.send у requests, HTTPTransport у httpx), а не модуль main,
+    тож записується й трафік рушія з будь-якого іншого модуля.
+    """
+    writer = CaptureWriter(fp)
+    real_adapter_send = requests.adapters.HTTPAdapter.send
+    real_handle_request = httpx.HTTPTransport.handle_request
+
+    def adapter_send(adapter, request, **kwargs):
+        started = time.monotonic()
+        try:
+            response = real_adapter_send(adapter, request, **kwargs)
+        except Exception as e:
+            writer.write(request.method, request.url, request_json(request.body), started, error=e)
+            raise
+        writer.write(request.method, request.url, request_json(request.body), started, response=response)
+        return response
+
+    def handle_request(transport, request):
+        started = time.monotonic()
+        try:
+            response = real_handle_request(transport, request)
+            response.read()
+        except Exception as e:
+            writer.write(request.method, str(request.url), request_json(request.content), started, error=e)
+            raise
+        writer.write(request.method, str(request.url), request_json(request.content), started, response=response)
+        return response
+
+    with mock.patch.object(requests.adapters.HTTPAdapter, "send", adapter_send), \
+            mock.patch.object(httpx.HTTPTransport, "handle_request", handle_request):
+        yield writer
+
+
+# ================== ВІДТВОРЕННЯ ==================
+class ReplayServer:
+    """Відповіді із запису: спершу той самий (method, url) по черзі, потім той самий endpoint."""
+
+    def __init__(self, entries, speed=0.0):
+        self.speed = speed
+        self.by_url = {}
+        self.by_endpoint = {}
+        # Власні копії: позначка "_used" не має перетікати між прогонами
+        for entry in (dict(e) for e in entries):
+            self.by_url.setdefault((entry["method"], entry["url"]), deque()).append(entry)
+            self.by_endpoint.setdefault(main.endpoint_key(entry["method"], entry["url"]), deque()).append(entry)
+        self.served = 0
+        self.unmatched = []
+        self.writes = []
+        self._lock = threading.Lock()  # пакетне створення звертається з кількох потоків
+
+    def _take(self, method, url):
+        for queue in (self.by_url.get((method, url)), self.by_endpoint.get(main.endpoint_key(method, url))):
+            while queue:
+                entry = queue.popleft()
+                if not entry.get("_used"):
+                    entry["_used"] = True
+                    return entry
+        return None
+
+    def serve(self, method, url, json_data=None):
+        url = redact_url(url)
+        with self._lock:
+            if method != "GET":
+                self.writes.append({"method": method, "endpoint": main.endpoint_key(method, url), "request": json_data})
+            entry = self._take(method, url)
+            if entry is None:
+                self.unmatched.append(f"{method} {url}")
+                return None
+            self.served += 1
+        if self.speed:
+            time.sleep(entry["elapsed"] / self.speed)
+        return entry
+
+
+def _requests_response(entry, request):
+    response = requests.Response()
+    response.status_code = entry["status"]
+    response._content = decode_body(entry)
+    response.headers = CaseInsensitiveDict(entry.get("headers") or {})
+    response.url = request.url
+    response.request = request
+    response.encoding = "utf-8"
+    return response
+
+
+# Шард-воркери (forkserver) заново імпортують main з налаштуваннями з env і без патчів
+# транспорту: їхній трафік не записався б, а при відтворенні пішов би в реальний магазин
+# і реальне сховище стану. Тому запис і відтворення — завжди в одному процесі (SYNC_SHARDS=1).
+@contextmanager
+def replaying(entries, speed=0.0):
+    """Транспорти requests/httpx відповідають із ReplayServer; стан і знімок каталогу — тимчасові."""
+    server = ReplayServer(entries, speed)
+
+    def adapter_send(adapter, request, **kwargs):
+        entry = server.serve(request.method, request.url, request_json(request.body))
+        if entry is None:
+            # Запиту немає в записі (новий рушій робить інші виклики) — нейтральна 200-ка
+            return _requests_response({"status": 200, "body": "{}"}, request)
+        if "error" in entry:
+            raise requests.ConnectionError(entry["error"], request=request)
+        return _requests_response(entry, request)
+
+    def handle_request(transport, request):
+        entry = server.serve(request.method, str(request.url), request_json(request.content))
+        if entry is None:
+            return httpx.Response(404, content=b"", request=request)
+        if "error" in entry:
+            raise httpx.ConnectError(entry["error"], request=request)
+        return httpx.Response(
+            entry["status"], content=decode_body(entry), headers=entry.get("headers") or {}, request=request,
+        )
+
+    real_wait = main.wait_for_rate_budget
+
+    def scaled_wait(name="shopify", interval=main.SHOPIFY_MIN_REQUEST_INTERVAL):
+        if speed:
+            real_wait(name, interval / speed)
+
+    with tempfile.TemporaryDirectory() as tmp, \
+            mock.patch.object(requests.adapters.HTTPAdapter, "send", adapter_send), \
+            mock.patch.object(httpx.HTTPTransport, "handle_request", handle_request), \
+            mock.patch.object(main, "url", ONE_C_PLACEHOLDER), \
+            mock.patch.object(main, "shopify_store_url", SHOPIFY_PLACEHOLDER), \
+            mock.patch.object(main, "access_token", "replay"), \
+            mock.patch.object(main, "wait_for_rate_budget", scaled_wait), \
+            mock.patch.object(main, "STATE_DB_PATH", os.path.join(tmp, "state.sqlite3")), \
+            mock.patch.object(main, "CATALOG_SNAPSHOT_PATH", os.path.join(tmp, "catalog.snapshot")), \
+            mock.patch.object(main, "circuit_breakers", {}), \
+            mock.patch.object(main, "deferred_requests", deque()), \
+            mock.patch.object(main, "SYNC_SHARDS", 1):
+        yield server
+
+
+# ================== РУШІЇ ==================
+def load_engine(spec):
+    """'module:function' → callable."""
+    module_name, _, attr = spec.partition(":")
+    return getattr(importlib.import_module(module_name), attr or "sync_products")
+
+
+def read_capture(path):
+    with open(path, encoding="utf-8") as fp:
+        return [json.loads(line) for line in fp if line.strip()]
+
+
+def record(path, engine):
+    """Реальний запуск engine із записом трафіку. Холодний знімок каталогу — щоб запис був повним."""
+    lock_file = main.acquire_sync_lock()
+    if not lock_file:
+        raise RuntimeError("Синхронізація вже виконується в іншому процесі.")
+    try:
+        with tempfile.TemporaryDirectory() as tmp, \
+                mock.patch.object(main, "CATALOG_SNAPSHOT_PATH", os.path.join(tmp, "catalog.snapshot")), \
+                mock.patch.object(main, "SYNC_SHARDS", 1), \
+                open(path, "w", encoding="utf-8") as fp, \
+                recording(fp) as writer, \
+                main.app.app_context():
+            engine()
+        print(f"📼 Записано {writer.seq} відповідей у {path}")
+        return writer.seq
+    finally:
+        main.release_sync_lock(lock_file)
+
+
+def replay(entries, engine, speed=0.0):
+    """Прогін engine на записі. Повертає звіт: час, обслужені/невідомі запити, записи в Shopify."""
+    with replaying(entries, speed) as server, main.app.app_context():
+        started = time.monotonic()
+        engine()
+        seconds = time.monotonic() - started
+    return {
+        "seconds": round(seconds, 3),
+        "served": server.served,
+        "unmatched": len(server.unmatched),
+        "writes": server.writes,
+    }
+
+
+def compare(entries, baseline, candidate, speed=0.0):
+    """A/B: обидва рушії на одному записі."""
+    reports = {"baseline": replay(entries, baseline, speed), "candidate": replay(entries, candidate, speed)}
+    baseline_writes = sorted(json.dumps(w, sort_keys=True) for w in reports["baseline"]["writes"])
+    candidate_writes = sorted(json.dumps(w, sort_keys=True) for w in reports["candidate"]["writes"])
+    for report in reports.values():
+        report["write_count"] = len(report.pop("writes"))
+    reports["writes_match"] = baseline_writes == candidate_writes
+    reports["speedup"] = (
+        round(reports["baseline"]["seconds"] / reports["candidate"]["seconds"], 2)
+        if reports["candidate"]["seconds"] else None
+    )
+    return reports
+
+
+def cli():
+    parser = argparse.ArgumentParser(description="Запис/відтворення трафіку 1С ↔ Shopify")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    rec = sub.add_parser("record", help="реальний запуск із записом відповідей")
+    rec.add_argument("capture")
+    rec.add_argument("--mode", choices=("sync", "plan"), default="plan",
+                     help="plan — лише читання (за замовчуванням), sync — повна синхронізація із записом у Shopify")
+
+    rep = sub.add_parser("replay", help="прогін рушія на записі")
+    rep.add_argument("capture")
+    rep.add_argument("--engine", default="main:sync_products")
+    rep.add_argument("--speed", type=float, default=0.0, help="1 — записані затримки, N — у N разів швидше, 0 — без затримок")
+
+    ab = sub.add_parser("ab", help="A/B двох рушіїв на одному записі")
+    ab.add_argument("capture")
+    ab.add_argument("--candidate", required=True)
+    ab.add_argument("--baseline", default="main:sync_products")
+    ab.add_argument("--speed", type=float, default=0.0)
+
+    args = parser.parse_args()
+    if args.command == "record":
+        record(args.capture, main.sync_products if args.mode == "sync" else main.plan_sync)
+        return 0
+
+    entries = read_capture(args.capture)
+    if args.command == "replay":
+        report = replay(entries, load_engine(args.engine), args.speed)
+        report["write_count"] = len(report.pop("writes"))
+    else:
+        report = compare(entries, load_engine(args.baseline), load_engine(args.candidate), args.speed)
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(cli())
@@ -1,39 +1,21 @@
-import main
-
-
-# Stop scheduler thread started at import to avoid side effects during tests.
-try:
-    main.scheduler.shutdown(wait=False)
-except Exception:
-    pass
-
+import pytest
 
-class DummyJob:
-    def __init__(self):
-        self.rescheduled = False
-
-    def reschedule(self, trigger):
-        self.rescheduled = True
-        self.trigger = trigger
-
-
-class DummyScheduler:
-    def __init__(self, job=None):
-        self.job = job
-        self.added = False
+import main
 
-    def get_job(self, _job_id):
-        return self.job
 
-    def add_job(self, **kwargs):
-        self.added = True
-        self.job = DummyJob()
+@pytest.fixture(autouse=True)
+def isolated_state_db(monkeypatch, tmp_path):
+    monkeypatch.setattr(main, "STATE_DB_PATH", str(tmp_path / "state.sqlite3"))
+    monkeypatch.setattr(main, "CATALOG_SNAPSHOT_PATH", str(tmp_path / "catalog.snapshot"))
+    monkeypatch.setattr(main, "circuit_breakers", {})
+    monkeypatch.setattr(main, "deferred_requests", main.deque())
 
 
 class DummyResponse:
-    def __init__(self, status_code, payload):
+    def __init__(self, status_code, payload, headers=None):
         self.status_code = status_code
         self._payload = payload
+        self.headers = headers or {}
 
     def json(self):
         return self._payload
@@ -52,12 +34,11 @@ def test_run_sync_returns_409_when_lock_is_busy(monkeypatch):
 
 def test_run_sync_success_path(monkeypatch):
     dummy_lock = object()
-    dummy_job = DummyJob()
 
     monkeypatch.setattr(main, "acquire_sync_lock", lambda: dummy_lock)
     monkeypatch.setattr(main, "release_sync_lock", lambda lock: None)
     monkeypatch.setattr(main, "sync_products", lambda: {"status": "finished"})
-    monkeypatch.setattr(main, "scheduler", DummyScheduler(job=dummy_job))
+    main.set_state(next_run_time=main.datetime.now(main.timezone.utc).isoformat())
 
     with main.app.test_client() as client:
         response = client.post("/run_sync")
@@ -65,7 +46,10 @@ def test_run_sync_success_path(monkeypatch):
     assert response.status_code == 200
     data = response.get_json()
     assert data["ok"] is True
-    assert dummy_job.rescheduled is True
+    # The next automatic run is pushed a full interval ahead in the shared state store.
+    next_run = main.datetime.fromisoformat(main.get_state("next_run_time"))
+    delay = next_run - main.datetime.now(main.timezone.utc)
+    assert main.timedelta(minutes=main.SCHEDULE_MINUTES - 1) < delay <= main.timedelta(minutes=main.SCHEDULE_MINUTES)
 
 
 def test_send_to_shopify_updates_existing_product_by_normalized_sku(monkeypatch):
@@ -234,3 +218,769 @@ def test_sync_products_aborts_when_shopify_catalog_fetch_failed(monkeypatch):
     assert response.status_code == 503
     assert response.get_json()["status"] == "Shopify catalog fetch failed. Sync aborted."
     assert called["send_to_shopify"] is False
+
+
+def test_shard_for_sku_is_stable_and_in_range():
+    shards = [main.shard_for_sku(f"{i:09d}", 8) for i in range(200)]
+
+    assert all(0 <= shard < 8 for shard in shards)
+    assert len(set(shards)) == 8
+    assert main.shard_for_sku(" 000000029 ", 8) == main.shard_for_sku("000000029", 8)
+
+
+def test_shard_lease_is_exclusive_and_not_reclaimed_after_completion():
+    assert main.acquire_shard_lease(0, "host:1:0", "run-a") is True
+    assert main.acquire_shard_lease(0, "host:1:1", "run-a") is False
+    # The owner renews its own lease.
+    assert main.acquire_shard_lease(0, "host:1:0", "run-a") is True
+
+    main.complete_shard_lease(0, "host:1:0")
+
+    assert main.acquire_shard_lease(0, "host:1:1", "run-a") is False
+    assert main.acquire_shard_lease(0, "host:2:0", "run-b") is True
+
+
+def test_shard_workers_process_every_sku_exactly_once(monkeypatch):
+    seen = []
+
+    def fake_send(shopify_product, existing_products, all_skus, all_handles):
+        seen.append(shopify_product["product"]["variants"][0]["sku"])
+        return True
+
+    monkeypatch.setattr(main, "send_to_shopify", fake_send)
+    products = [
+        {"id": f"{i:09d}", "name": f"Item {i}", "price": [{"type_price": "ТОВ", "amount": "10"}]}
+        for i in range(40)
+    ]
+
+    first = main.run_shard_worker(0, products, [], 4, "run-1")
+    second = main.run_shard_worker(1, products, [], 4, "run-1")
+
+    assert sorted(first) == [0, 1, 2, 3]
+    assert second == []
+    assert sorted(seen) == sorted(p["id"] for p in products)
+
+
+def test_concurrent_hosts_join_one_shared_run_and_split_shards(monkeypatch):
+    seen = []
+
+    def fake_send(shopify_product, existing_products, all_skus, all_handles):
+        seen.append(shopify_product["product"]["variants"][0]["sku"])
+        return True
+
+    monkeypatch.setattr(main, "send_to_shopify", fake_send)
+    products = [
+        {"id": f"{i:09d}", "name": f"Item {i}", "price": [{"type_price": "ТОВ", "amount": "10"}]}
+        for i in range(40)
+    ]
+
+    shared_a = main.join_shard_run(4)
+    shared_b = main.join_shard_run(4)
+    assert shared_a == shared_b
+
+    # Each host keeps its own run_id for metrics; leases live in the shared run.
+    first = main.run_shard_worker(0, products, [], 4, "host-a-run", lease_run_id=shared_a)
+    second = main.run_shard_worker(0, products, [], 4, "host-b-run", lease_run_id=shared_b)
+
+    assert sorted(first) == [0, 1, 2, 3]
+    assert second == []
+    assert sorted(seen) == sorted(p["id"] for p in products)
+    # Once every shard is done the next sync opens a fresh run.
+    assert main.join_shard_run(4) != shared_a
+
+
+def test_abandoned_shared_run_is_not_joined(monkeypatch):
+    abandoned = main.join_shard_run(4)
+    assert main.acquire_shard_lease(0, "dead-host:1:0", abandoned, ttl=0) is True
+
+    monkeypatch.setattr(main, "SHARD_LEASE_SECONDS", 0)
+
+    assert main.join_shard_run(4) != abandoned
+
+
+def test_process_products_writes_out_of_stock_before_price_and_creates(monkeypatch):
+    order = []
+
+    def fake_send(shopify_product, existing_products, all_skus, all_handles):
+        order.append(shopify_product["product"]["variants"][0]["sku"])
+        return True
+
+    monkeypatch.setattr(main, "send_to_shopify", fake_send)
+
+    existing_products = [
+        {"id": 1, "handle": "a", "variants": [{"id": 11, "sku": "price", "price": "12.00", "inventory_quantity": 5}]},
+        {"id": 2, "handle": "b", "variants": [{"id": 12, "sku": "sold-out", "price": "12.00", "inventory_quantity": 9}]},
+        {"id": 3, "handle": "c", "variants": [{"id": 13, "sku": "drop", "price": "12.00", "inventory_quantity": 100}]},
+    ]
+    products = [
+        {"id": "new", "name": "New", "quantity": "3", "price": [{"type_price": "ТОВ", "amount": "10"}]},
+        {"id": "price", "name": "Price", "quantity": "5", "price": [{"type_price": "ТОВ", "amount": "20"}]},
+        {"id": "drop", "name": "Drop", "quantity": "10", "price": [{"type_price": "ТОВ", "amount": "10"}]},
+        {"id": "sold-out", "name": "Sold out", "quantity": "0", "price": [{"type_price": "ТОВ", "amount": "10"}]},
+    ]
+    all_skus, all_handles = main.build_catalog_indexes(existing_products)
+    stats = {}
+
+    main.process_products(products, existing_products, all_skus, all_handles, stats=stats)
+
+    assert order == ["sold-out", "drop", "price", "new"]
+    assert {name: entry["count"] for name, entry in stats.items()} == {
+        "out_of_stock": 1, "stock_drop": 1, "price": 1, "create": 1,
+    }
+
+
+def test_propagation_report_uses_latest_run():
+    main.flush_propagation_stats("old", {"price": {"count": 1, "total_seconds": 9.0, "max_seconds": 9.0}})
+    main.flush_propagation_stats("new", {"out_of_stock": {"count": 2, "total_seconds": 3.0, "max_seconds": 2.0}})
+    main.flush_propagation_stats("new", {"out_of_stock": {"count": 1, "total_seconds": 3.0, "max_seconds": 3.0}})
+
+    assert main.get_propagation_report() == {
+        "out_of_stock": {"count": 3, "avg_seconds": 2.0, "max_seconds": 3.0},
+    }
+
+
+def _run(changed, total=100, duration_seconds=600, min_headroom=0.8, throttled=0):
+    return {
+        "duration_seconds": duration_seconds,
+        "total": total,
+        "changed": changed,
+        "min_headroom": min_headroom,
+        "throttled": throttled,
+    }
+
+
+def test_adaptive_interval_shortens_on_many_changes_and_lengthens_when_quiet():
+    minutes, reason = main.compute_adaptive_interval(180, [_run(changed=50)])
+    assert minutes == 90
+    assert "частіше" in reason
+
+    minutes, _ = main.compute_adaptive_interval(180, [_run(changed=0)])
+    assert minutes == 270
+
+    minutes, reason = main.compute_adaptive_interval(300, [_run(changed=0)])
+    assert minutes == main.ADAPTIVE_MAX_MINUTES
+    assert "обмежено" in reason
+
+
+def test_adaptive_interval_respects_rate_limit_headroom_and_run_duration():
+    minutes, _ = main.compute_adaptive_interval(180, [_run(changed=50, min_headroom=0.05)])
+    assert minutes == 180
+
+    # A 40 minute run must not be rescheduled more often than every 80 minutes.
+    minutes, _ = main.compute_adaptive_interval(120, [_run(changed=90, duration_seconds=2400)])
+    assert minutes == 80
+
+
+def test_status_reports_interval_and_reason(monkeypatch):
+    monkeypatch.setattr(main, "ADAPTIVE_SCHEDULE", True)
+    main.set_state(interval_minutes=45, interval_reason="багато змін (40% SKU) — частіше")
+
+    with main.app.test_client() as client:
+        data = client.get("/status").get_json()
+
+    assert data["interval_minutes"] == 45
+    assert data["interval_reason"].startswith("багато змін")
+
+
+def test_stored_adaptive_interval_is_ignored_once_adaptive_mode_is_off(monkeypatch):
+    monkeypatch.setattr(main, "ADAPTIVE_SCHEDULE", False)
+    main.set_state(interval_minutes=45, interval_reason="багато змін (40% SKU) — частіше")
+
+    with main.app.test_client() as client:
+        data = client.get("/status").get_json()
+
+    assert data["interval_minutes"] == main.SCHEDULE_MINUTES
+    assert data["interval_reason"] == "базовий інтервал"
+
+
+def test_dashboard_subtitle_shows_current_interval(monkeypatch):
+    monkeypatch.setattr(main, "ADAPTIVE_SCHEDULE", True)
+    main.set_state(interval_minutes=45, interval_reason="багато змін (40% SKU) — частіше")
+
+    with main.app.test_client() as client:
+        html = client.get("/").get_data(as_text=True)
+
+    assert 'кожні <span id="subtitle-interval">45</span> хв' in html
+
+
+def test_plan_endpoint_streams_changes_without_writing(monkeypatch):
+    monkeypatch.setattr(
+        main,
+        "fetch_products",
+        lambda: [
+            {"id": "000000029", "name": "LEMO", "quantity": "0", "price": [{"type_price": "ТОВ", "amount": "100"}]},
+            {"id": "000000030", "name": "Same", "quantity": "3", "price": [{"type_price": "ТОВ", "amount": "10"}]},
+            {"id": "000000031", "name": "Brand New", "quantity": "1", "price": [{"type_price": "ТОВ", "amount": "5"}]},
+            {"id": "000000032", "name": "No price", "price": []},
+        ],
+    )
+    monkeypatch.setattr(
+        main,
+        "fetch_all_shopify_products",
+        lambda: [
+            {"id": 1, "handle": "lemo", "variants": [
+                {"id": 11, "inventory_item_id": 21, "sku": "000000029", "price": "110.00", "inventory_quantity": 4}]},
+            {"id": 2, "handle": "same", "variants": [
+                {"id": 12, "inventory_item_id": 22, "sku": "000000030", "price": "12.00", "inventory_quantity": 3}]},
+        ],
+    )
+
+    def must_not_write(*args, **kwargs):
+        raise AssertionError("dry-run must not call Shopify write APIs")
+
+    monkeypatch.setattr(main, "send_request_with_retry", must_not_write)
+    monkeypatch.setattr(main.requests, "post", must_not_write)
+
+    with main.app.test_client() as client:
+        response = client.get("/plan")
+
+    assert response.status_code == 200
+    rows = main.read_plan_jsonl(response.get_data(as_text=True).splitlines())
+    summary, actions = rows[0], rows[1:]
+    assert summary["action"] == "summary"
+    assert summary["estimated_api_calls"] == 3
+    assert [(r["action"], r.get("sku")) for r in actions] == [
+        ("update_price", "000000029"),
+        ("update_quantity", "000000029"),
+        ("create", "000000031"),
+        ("skip", "000000030"),
+        ("skip", "000000032"),
+    ]
+    assert actions[1]["inventory_item_id"] == 21
+    assert actions[1]["new_quantity"] == 0
+
+
+def test_execute_plan_replays_saved_actions(monkeypatch):
+    calls = []
+    monkeypatch.setattr(main, "update_variant_price", lambda *args: calls.append(("price",) + args) or True)
+    monkeypatch.setattr(main, "update_variant_quantity", lambda *args: calls.append(("quantity",) + args) or True)
+    monkeypatch.setattr(
+        main, "send_to_shopify", lambda product, *args: calls.append(("create", product["product"]["handle"])) or True)
+
+    plan_rows = [
+        {"action": "summary", "counts": {}},
+        {"action": "update_quantity", "sku": "1", "variant_id": 11, "inventory_item_id": 21, "new_quantity": 0},
+        {"action": "update_price", "sku": "1", "variant_id": 11, "new_price": "120.00"},
+        {"action": "create", "sku": "2", "product": {"handle": "brand-new", "variants": [{"sku": "2"}]}},
+        {"action": "skip", "reason": "unchanged", "sku": "3"},
+    ]
+
+    done = main.execute_plan(plan_rows)
+
+    assert calls == [("quantity", 11, 21, 0), ("price", 11, "120.00"), ("create", "brand-new")]
+    assert done == {"create": 1, "update_price": 1, "update_quantity": 1, "failed": 0}
+
+
+def test_plan_endpoint_returns_409_while_sync_holds_the_lock(monkeypatch):
+    monkeypatch.setattr(main, "acquire_sync_lock", lambda: None)
+    monkeypatch.setattr(main, "plan_sync", lambda: pytest.fail("plan must not reset a running sync's metrics"))
+
+    with main.app.test_client() as client:
+        response = client.get("/plan")
+
+    assert response.status_code == 409
+
+
+def test_execute_plan_starts_with_a_fresh_retry_budget(monkeypatch):
+    budgets = []
+    monkeypatch.setattr(main, "update_variant_price",
+                        lambda *args: budgets.append(main.retry_budget["remaining"]) or True)
+    main.retry_budget["remaining"] = 0  # spent by an earlier sync in this process
+
+    main.execute_plan([{"action": "update_price", "sku": "1", "variant_id": 11, "new_price": "1.00"}])
+
+    assert budgets == [main.RETRY_BUDGET_PER_RUN]
+
+
+def test_execute_plan_counts_rejected_creates_as_failed(monkeypatch):
+    monkeypatch.setattr(main, "send_to_shopify", lambda product, *args: product["product"]["handle"] == "ok")
+
+    plan_rows = [
+        {"action": "create", "sku": "1", "product": {"handle": "ok", "variants": [{"sku": "1"}]}},
+        {"action": "create", "sku": "2", "product": {"handle": "rejected", "variants": [{"sku": "2"}]}},
+    ]
+
+    assert main.execute_plan(plan_rows) == {"create": 1, "update_price": 0, "update_quantity": 0, "failed": 1}
+
+
+def test_plan_estimate_uses_graphql_budget_for_bulk_creates_and_measured_headroom(monkeypatch):
+    monkeypatch.setattr(main, "BULK_CREATE_MIN_ITEMS", 2)
+    products = [
+        {"id": f"new-{i}", "name": f"New {i}", "quantity": "1", "price": [{"type_price": "ТОВ", "amount": "5"}]}
+        for i in range(2)
+    ] + [{"id": "old", "name": "Old", "quantity": "1", "price": [{"type_price": "ТОВ", "amount": "5"}]}]
+    existing = [{"id": 1, "handle": "old", "variants": [
+        {"id": 11, "inventory_item_id": 21, "sku": "old", "price": "1.00", "inventory_quantity": 1}]}]
+
+    relaxed = main.build_plan(products, existing, headroom=1.0)[0]
+    busy = main.build_plan(products, existing, headroom=0.5)[0]
+
+    assert relaxed["estimated_graphql_calls"] == 2
+    assert relaxed["estimated_rest_calls"] == 1
+    assert relaxed["estimated_seconds"] == round(
+        main.SHOPIFY_MIN_REQUEST_INTERVAL + 2 * main.SHOPIFY_GRAPHQL_MIN_REQUEST_INTERVAL, 1)
+    assert busy["rate_limit_headroom"] == 0.5
+    assert busy["estimated_seconds"] > relaxed["estimated_seconds"]
+
+
+def test_send_request_with_retry_retries_5xx_with_jittered_backoff(monkeypatch):
+    responses = [DummyResponse(503, {}), DummyResponse(502, {}), DummyResponse(200, {"ok": True})]
+    sleeps = []
+
+    monkeypatch.setattr(main, "wait_for_rate_budget", lambda: None)
+    monkeypatch.setattr(main.time, "sleep", sleeps.append)
+    monkeypatch.setattr(main.requests, "put", lambda *args, **kwargs: responses.pop(0))
+
+    response = main.send_request_with_retry("https://shop/admin/api/2024-01/variants/1.json", method="PUT")
+
+    assert response.status_code == 200
+    assert len(sleeps) == 2
+    assert 0 <= sleeps[0] <= main.RETRY_BASE_DELAY
+    assert 0 <= sleeps[1] <= main.RETRY_BASE_DELAY * 2
+
+
+def test_open_breaker_parks_requests_and_drains_after_recovery(monkeypatch):
+    calls = []
+    healthy = {"value": False}
+
+    def fake_put(url, headers=None, json=None):
+        calls.append(url)
+        return DummyResponse(200 if healthy["value"] else 500, {})
+
+    monkeypatch.setattr(main, "wait_for_rate_budget", lambda: None)
+    monkeypatch.setattr(main.time, "sleep", lambda seconds: None)
+    monkeypatch.setattr(main.requests, "put", fake_put)
+
+    url = "https://shop/admin/api/2024-01/variants/{}.json"
+    assert main.send_request_with_retry(url.format(1), method="PUT").status_code == 500
+    breaker = main.get_circuit_breaker("PUT /admin/api/2024-01/variants/{id}.json")
+    assert breaker.state == "open"
+    assert len(calls) == main.BREAKER_FAILURE_THRESHOLD
+
+    # While open, work is parked without touching the API.
+    assert main.send_request_with_retry(url.format(2), method="PUT") is None
+    assert len(calls) == main.BREAKER_FAILURE_THRESHOLD
+    assert len(main.deferred_requests) == 2
+
+    healthy["value"] = True
+    breaker.opened_at -= breaker.cooldown
+    assert main.send_request_with_retry(url.format(3), method="PUT").status_code == 200
+
+    assert breaker.state == "closed"
+    assert len(main.deferred_requests) == 0
+    assert calls[-3:] == [url.format(3), url.format(1), url.format(2)]
+
+
+def test_deferred_drain_renews_shard_lease_while_waiting_for_breaker(monkeypatch):
+    endpoint = "PUT /admin/api/2024-01/variants/{id}.json"
+    breaker = main.get_circuit_breaker(endpoint)
+    for _ in range(main.BREAKER_FAILURE_THRESHOLD):
+        breaker.record_failure()
+    main.defer_request(endpoint, "https://shop/admin/api/2024-01/variants/1.json", "PUT", {}, {})
+    assert main.acquire_shard_lease(0, "host:1:0", "run", ttl=1) is True
+
+    heartbeats = []
+
+    def heartbeat():
+        heartbeats.append(True)
+        return main.acquire_shard_lease(0, "host:1:0", "run")
+
+    def fake_sleep(seconds):
+        breaker.opened_at -= breaker.cooldown  # the cooldown passes while we wait
+
+    monkeypatch.setattr(main.time, "sleep", fake_sleep)
+    monkeypatch.setattr(main, "wait_for_rate_budget", lambda: None)
+    monkeypatch.setattr(main.requests, "put", lambda *args, **kwargs: DummyResponse(200, {}))
+
+    assert main.drain_deferred_requests(max_wait=main.DEFERRED_DRAIN_MAX_SECONDS, heartbeat=heartbeat) == 1
+    assert heartbeats
+    # The renewed lease is still ours, so nobody else can claim the shard.
+    assert main.acquire_shard_lease(0, "host:2:0", "run") is False
+
+
+def test_shard_lost_during_drain_is_not_reported_as_processed():
+    assert main.acquire_shard_lease(0, "host:1:0", "run", ttl=0) is True
+    assert main.acquire_shard_lease(0, "host:2:0", "run") is True
+
+    assert main.complete_shard_lease(0, "host:1:0") is False
+    assert main.complete_shard_lease(0, "host:2:0") is True
+
+
+def test_catalog_crawl_retries_failed_page_from_its_cursor(monkeypatch):
+    requested = []
+    pages = {
+        None: DummyResponse(200, {"products": [{"id": 1, "handle": "a", "variants": []}]},
+                            {"Link": '<https://shop/products.json?page_info=p2>; rel="next"'}),
+        "https://shop/products.json?page_info=p2": [
+            DummyResponse(502, {}),
+            DummyResponse(200, {"products": [{"id": 2, "handle": "b", "variants": []}]}),
+        ],
+    }
+
+    def fake_get(url, headers=None, params=None, timeout=None):
+        requested.append(url if params is None else None)
+        page = pages[requested[-1]]
+        return page.pop(0) if isinstance(page, list) else page
+
+    monkeypatch.setattr(main, "wait_for_rate_budget", lambda: None)
+    monkeypatch.setattr(main.time, "sleep", lambda seconds: None)
+    monkeypatch.setattr(main.requests, "get", fake_get)
+
+    products = main.crawl_shopify_products()
+
+    assert [p["id"] for p in products] == [1, 2]
+    # Page 1 is fetched once; only the failed cursor is retried.
+    assert requested == [None, "https://shop/products.json?page_info=p2", "https://shop/products.json?page_info=p2"]
+
+
+def test_catalog_crawl_counts_429_and_honours_retry_after(monkeypatch):
+    responses = [
+        DummyResponse(429, {}, {"Retry-After": "7.0"}),
+        DummyResponse(200, {"products": [{"id": 1, "handle": "a", "variants": []}]}),
+    ]
+    sleeps = []
+
+    monkeypatch.setattr(main, "wait_for_rate_budget", lambda: None)
+    monkeypatch.setattr(main.time, "sleep", sleeps.append)
+    monkeypatch.setattr(main.requests, "get", lambda *args, **kwargs: responses.pop(0))
+    main.reset_run_metrics()
+
+    products = main.crawl_shopify_products()
+
+    assert [p["id"] for p in products] == [1]
+    assert sleeps == [7.0]
+    assert main.run_metrics["throttled"] == 1
+
+
+def test_warm_catalog_fetch_only_requests_changes_since_snapshot(monkeypatch):
+    crawls = []
+
+    def fake_crawl(extra_params=None):
+        crawls.append(extra_params)
+        if extra_params is None:
+            return [
+                {"id": 1, "handle": "a", "title": "dropped", "variants": [{"id": 11, "sku": "1", "price": "1.00"}]},
+                {"id": 2, "handle": "b", "variants": [{"id": 12, "sku": "2", "price": "2.00"}]},
+            ]
+        return [{"id": 2, "handle": "b", "variants": [{"id": 12, "sku": "2", "price": "3.00"}]}]
+
+    monkeypatch.setattr(main, "crawl_shopify_products", fake_crawl)
+    monkeypatch.setattr(main, "crawl_inventory_levels", lambda since: [])
+
+    cold = main.fetch_all_shopify_products()
+    warm = main.fetch_all_shopify_products()
+
+    assert crawls[0] is None
+    assert set(crawls[1]) == {"updated_at_min"}
+    assert "title" not in cold[0]
+    assert {p["id"]: p["variants"][0]["price"] for p in warm} == {1: "1.00", 2: "3.00"}
+
+
+def test_warm_catalog_picks_up_stock_written_since_snapshot_so_restock_is_planned(monkeypatch):
+    variant = {"id": 11, "inventory_item_id": 21, "sku": "000000029", "price": "120.00", "inventory_quantity": 9}
+    requested = []
+
+    def fake_get(url, headers=None, params=None, timeout=None):
+        requested.append((url.rsplit("/", 1)[-1], params))
+        if url.endswith("/inventory_levels.json"):
+            # The sync set the stock to 0; Shopify does not bump the product's updated_at for that.
+            return DummyResponse(200, {"inventory_levels": [
+                {"inventory_item_id": 21, "location_id": main.SHOPIFY_LOCATION_ID, "available": 0}]})
+        if params and "updated_at_min" in params:
+            return DummyResponse(200, {"products": []})
+        return DummyResponse(200, {"products": [{"id": 1, "handle": "lemo", "variants": [variant]}]})
+
+    monkeypatch.setattr(main, "wait_for_rate_budget", lambda: None)
+    monkeypatch.setattr(main.requests, "get", fake_get)
+    feed = [{"id": "000000029", "name": "LEMO", "quantity": "9", "price": [{"type_price": "ТОВ", "amount": "100"}]}]
+
+    main.fetch_all_shopify_products()
+    warm = main.fetch_all_shopify_products()
+    plan_rows = main.build_plan(feed, warm)
+
+    assert requested[-1][0] == "inventory_levels.json"
+    assert requested[-1][1]["location_ids"] == main.SHOPIFY_LOCATION_ID
+    assert "updated_at_min" in requested[-1][1]
+    assert [(r["action"], r.get("old_quantity"), r.get("new_quantity")) for r in plan_rows[1:]] == [
+        ("update_quantity", 0, 9),
+    ]
+
+
+def test_slugify_handle_transliterates_and_sanitizes():
+    assert main.slugify_handle("LEMO Манго-Маракуйя") == "lemo-mango-marakujya"
+    assert main.slugify_handle("EASY MIXERS MOJITO -BOT50CL") == "easy-mixers-mojito-bot50cl"
+    assert main.slugify_handle("Сироп «Їжачок» 0,7 л / Café!") == "sirop-yizhachok-0-7-l-cafe"
+    assert main.slugify_handle("!!!") == "product"
+
+
+def test_send_to_shopify_resolves_handle_collision_locally(monkeypatch):
+    posted = {}
+
+    def fake_post(url, headers=None, json=None):
+        posted["handle"] = json["product"]["handle"]
+        return DummyResponse(201, {"product": {"handle": json["product"]["handle"], "variants": [{"sku": "000000031"}]}})
+
+    monkeypatch.setattr(main, "wait_for_rate_budget", lambda: None)
+    monkeypatch.setattr(main.requests, "post", fake_post)
+
+    all_handles = {"lemo-mango", "lemo-mango-1"}
+    shopify_product = {
+        "product": {
+            "handle": "lemo-mango",
+            "variants": [{"sku": "000000031", "price": "10.00", "inventory_quantity": 1}],
+        }
+    }
+
+    main.send_to_shopify(shopify_product, [], set(), all_handles)
+
+    assert posted["handle"] == "lemo-mango-2"
+    assert "lemo-mango-2" in all_handles
+
+
+def test_shard_workers_reserve_handles_in_shared_state():
+    # Two workers start from the same catalog snapshot.
+    first = main.SharedHandleSet({"same-name"}, "run")
+    second = main.SharedHandleSet({"same-name"}, "run")
+
+    assert main.allocate_handle("same-name", first) == "same-name-1"
+    assert main.allocate_handle("same-name", second) == "same-name-2"
+
+    # A handle released after a failed create can be reused.
+    first.discard("same-name-1")
+    assert main.allocate_handle("same-name", second) == "same-name-1"
+
+
+def _graphql_created(product_id, handle, sku):
+    return DummyResponse(200, {"data": {"productSet": {
+        "product": {
+            "id": f"gid://shopify/Product/{product_id}",
+            "handle": handle,
+            "variants": {"nodes": [{
+                "id": f"gid://shopify/ProductVariant/{product_id + 1000}",
+                "sku": sku,
+                "inventoryItem": {"id": f"gid://shopify/InventoryItem/{product_id + 2000}"},
+            }]},
+        },
+        "userErrors": [],
+    }}})
+
+
+def test_bulk_create_uses_product_set_and_merges_results_into_indexes(monkeypatch):
+    rest_creates = []
+
+    def fake_post(url, headers=None, json=None):
+        if url.endswith("/graphql.json"):
+            data = json["variables"]["input"]
+            sku = data["variants"][0]["sku"]
+            if sku == "bad":
+                return DummyResponse(200, {"data": {"productSet": {
+                    "product": None, "userErrors": [{"field": ["input"], "message": "boom", "code": "INVALID"}]}}})
+            return _graphql_created(int(sku), data["handle"], sku)
+        rest_creates.append(json["product"]["handle"])
+        return DummyResponse(201, {"product": {"handle": json["product"]["handle"], "variants": [{"sku": "bad"}]}})
+
+    monkeypatch.setattr(main, "wait_for_rate_budget", lambda *args: None)
+    monkeypatch.setattr(main.requests, "post", fake_post)
+
+    products = [
+        main.transform_to_shopify_format(
+            {"id": str(i), "name": "Same Name", "quantity": "1", "price": [{"type_price": "ТОВ", "amount": "10"}]})
+        for i in range(1, 4)
+    ]
+    products.append(main.transform_to_shopify_format(
+        {"id": "bad", "name": "Bad", "quantity": "1", "price": [{"type_price": "ТОВ", "amount": "10"}]}))
+    existing_products, all_skus, all_handles = [], set(), {"same-name"}
+    created = []
+
+    count = main.create_products_bulk(products, existing_products, all_skus, all_handles, created.append)
+
+    # Three via productSet, one via the REST fallback.
+    assert count == 4
+    assert len(created) == 4
+    assert all_skus == {"1", "2", "3", "bad"}
+    assert {"same-name-1", "same-name-2", "same-name-3", "bad"} <= all_handles
+    # A failed mutation falls back to the REST create path with its handle released.
+    assert rest_creates == ["bad"]
+    assert {p["variants"][0]["inventory_item_id"] for p in existing_products if p.get("id")} == {2001, 2002, 2003}
+
+
+def test_bulk_create_sends_duplicate_feed_sku_once_and_reports_only_successful_fallbacks(monkeypatch):
+    mutations = []
+    rest_updates = []
+
+    def fake_post(url, headers=None, json=None):
+        if url.endswith("/graphql.json"):
+            data = json["variables"]["input"]
+            sku = data["variants"][0]["sku"]
+            mutations.append(sku)
+            if sku == "bad":
+                return DummyResponse(400, {})
+            return _graphql_created(int(sku), data["handle"], sku)
+        return DummyResponse(422, {"errors": {"base": ["rejected"]}})
+
+    monkeypatch.setattr(main, "wait_for_rate_budget", lambda *args: None)
+    monkeypatch.setattr(main.requests, "post", fake_post)
+    monkeypatch.setattr(main, "fetch_all_shopify_products", lambda: [])
+    monkeypatch.setattr(main, "update_shopify_variant", lambda *args: rest_updates.append(args[0]) or True)
+
+    products = [
+        main.transform_to_shopify_format(
+            {"id": sku, "name": name, "quantity": "1", "price": [{"type_price": "ТОВ", "amount": "10"}]})
+        for sku, name in (("1", "Twice"), ("1", "Twice"), ("bad", "Bad"))
+    ]
+    created = []
+
+    count = main.create_products_bulk(products, [], set(), set(), created.append)
+
+    # The repeated SKU goes through the REST path after the batch and updates the new product.
+    assert mutations.count("1") == 1
+    assert rest_updates == [1001]
+    # The failed productSet falls back to REST, which is rejected too, so it is not reported as created.
+    assert count == 2
+    assert [p["product"]["variants"][0]["sku"] for p in created] == ["1", "1"]
+
+
+def test_process_products_switches_to_bulk_create_for_large_batches(monkeypatch):
+    batches = []
+    monkeypatch.setattr(main, "BULK_CREATE_MIN_ITEMS", 2)
+    monkeypatch.setattr(main, "create_products_bulk",
+                        lambda products, *args: batches.append([p["product"]["variants"][0]["sku"] for p in products]))
+    monkeypatch.setattr(main, "send_to_shopify", lambda *args: True)
+
+    products = [
+        {"id": str(i), "name": f"Item {i}", "quantity": "1", "price": [{"type_price": "ТОВ", "amount": "10"}]}
+        for i in range(3)
+    ]
+
+    main.process_products(products, [], set(), set())
+
+    assert batches == [["0", "1", "2"]]
+
+
+def _finished_run(run_id, items, duration):
+    started_at = main.time.monotonic() - duration
+    main.finish_run(run_id, "finished", items, started_at, main.datetime.now(main.timezone.utc))
+
+
+def test_sync_run_is_recorded_with_phases_requests_and_throughput(monkeypatch):
+    monkeypatch.setattr(
+        main,
+        "fetch_products",
+        lambda: [{"id": "000000029", "name": "LEMO", "quantity": "1", "price": [{"type_price": "ТОВ", "amount": "1"}]}],
+    )
+    monkeypatch.setattr(
+        main,
+        "fetch_all_shopify_products",
+        lambda: [{"id": 1, "handle": "lemo", "variants": [{"id": 11, "inventory_item_id": 21, "sku": "000000029"}]}],
+    )
+
+    def fake_update(variant_id, inventory_item_id, new_price, new_quantity):
+        main.count_request("PUT /admin/api/2024-01/variants/{id}.json")
+        main.count_throttled()
+        return True
+
+    monkeypatch.setattr(main, "update_shopify_variant", fake_update)
+
+    with main.app.test_client() as client:
+        assert client.get("/sync_products").status_code == 200
+        runs = client.get("/runs").get_json()["runs"]
+
+    assert len(runs) == 1
+    run = runs[0]
+    assert run["status"] == "finished"
+    assert run["items"] == 1
+    assert run["changed"] == 1
+    assert run["throttled"] == 1
+    assert run["requests"] == {"PUT /admin/api/2024-01/variants/{id}.json": 1}
+    assert {"fetch_1c", "fetch_shopify", "diff", "write"} <= set(run["phases"])
+    assert run["throughput"] > 0
+    assert run["regression"] is False
+
+
+def test_run_records_lowest_headroom_flushed_by_shard_workers():
+    # Each shard worker flushes its own counters...
+    for used in ("36/40", "20/40"):
+        main.reset_run_metrics()
+        main.record_rate_limit_headroom(DummyResponse(200, {}, {"X-Shopify-Shop-Api-Call-Limit": used}))
+        main.flush_run_counters("sharded")
+    # ...while the parent only crawled the catalog.
+    main.reset_run_metrics()
+    main.record_rate_limit_headroom(DummyResponse(200, {}, {"X-Shopify-Shop-Api-Call-Limit": "4/40"}))
+
+    _finished_run("sharded", items=10, duration=5)
+
+    assert main.load_runs()[0]["min_headroom"] == pytest.approx(0.1)
+
+
+def test_run_is_flagged_when_throughput_drops_below_rolling_baseline():
+    for i in range(3):
+        _finished_run(f"base-{i}", items=1000, duration=100)
+    _finished_run("ok", items=900, duration=100)
+    _finished_run("slow", items=1000, duration=400)
+
+    by_id = {run["run_id"]: run for run in main.load_runs()}
+
+    assert by_id["base-2"]["baseline_throughput"] is None
+    assert by_id["ok"]["regression"] is False
+    assert by_id["slow"]["regression"] is True
+    assert by_id["slow"]["baseline_throughput"] == pytest.approx(10.0, rel=1e-3)
+
+
+def test_import_has_no_scheduler_side_effects():
+    assert main.scheduler is None
+
+
+def test_scheduler_tick_runs_sync_only_when_due(monkeypatch):
+    runs = []
+    monkeypatch.setattr(main, "scheduled_sync", lambda: runs.append(True))
+
+    main.scheduler_tick()
+    assert runs == []
+    assert main.get_state("next_run_time") is not None
+
+    main.set_state(next_run_time=(main.datetime.now(main.timezone.utc) - main.timedelta(seconds=1)).isoformat())
+    main.scheduler_tick()
+    assert runs == [True]
+
+
+def test_heartbeat_keeps_running_while_tick_is_busy_with_a_sync(monkeypatch):
+    sync_started = main.threading.Event()
+    release_sync = main.threading.Event()
+
+    def long_sync():
+        sync_started.set()
+        release_sync.wait(10)
+
+    monkeypatch.setattr(main, "SCHEDULER_TICK_SECONDS", 0.2)
+    monkeypatch.setattr(main, "scheduled_sync", long_sync)
+    monkeypatch.setattr(main, "scheduler", None)
+    main.set_state(next_run_time=(main.datetime.now(main.timezone.utc) - main.timedelta(seconds=1)).isoformat())
+
+    scheduler = main.start_scheduler()
+    try:
+        assert sync_started.wait(5)
+        main.time.sleep(0.1)
+        first = main.get_state("scheduler_heartbeat")
+        main.time.sleep(0.5)
+
+        assert main.get_state("scheduler_heartbeat") > first
+        assert main.is_scheduler_alive()
+    finally:
+        release_sync.set()
+        scheduler.shutdown(wait=True)
+
+
+def test_status_is_served_from_shared_state_store():
+    main.set_state(
+        last_run_time="2026-10-19T06:00:00+00:00",
+        next_run_time="2026-10-19T09:00:00+00:00",
+        scheduler_heartbeat=main.datetime.now(main.timezone.utc).isoformat(),
+    )
+
+    # Any web worker (here: a fresh test client) sees the same status.
+    with main.app.test_client() as client:
+        data = client.get("/status").get_json()
+
+    assert data["last_run_time"] == "2026-10-19T06:00:00+00:00"
+    assert data["next_run_time"] == "2026-10-19T09:00:00+00:00"
+    assert data["job_exists"] is True
@@ -0,0 +1,6 @@
+"""WSGI-точка входу: gunicorn -c gunicorn.conf.py wsgi:app
+
+Імпорт main не запускає планувальник — його запускають окремим процесом:
+python main.py --scheduler
+"""
+from main import app